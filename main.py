@@ -1,12 +1,16 @@
 import os
-import json
-import tempfile
 import re
+import json
+import time
+import string
+import uuid
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from src.lovbuy_client import LovbuyClient
-from src.update_google_sheet import run_sheet_update
+from src.update_google_sheet import run_sheet_update_batch
 from src.logging_config import setup_logging
 
 # Set up logging
@@ -14,174 +18,288 @@ logger = setup_logging()
 
 load_dotenv(override=True)
 
-app = Flask(__name__, static_folder='frontend')
+# Frontend files are served straight from the static route at the site root
+app = Flask(__name__, static_folder='frontend', static_url_path='')
+# Let browsers reuse static files for an hour; send_file adds Last-Modified/ETag for conditional 304s
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600
+# Let the WSGI server log unhandled errors instead of Flask swallowing them
+app.config['PROPAGATE_EXCEPTIONS'] = True
 
 LOVBUY_API_KEY = os.getenv("LOVBUY_API_KEY")
 GOOGLE_APPLICATION_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
 
+# One client for the whole process: its session keeps LovBuy connections alive across requests.
+# Left as None when the key is missing; _check_configuration reports that per request.
+_LOVBUY = LovbuyClient(LOVBUY_API_KEY) if LOVBUY_API_KEY else None
+
+# Shared worker pool for LovBuy fetches and sheet writes. Each URL is I/O-bound,
+# so a bounded pool lets a batch finish in roughly the time of the slowest URL.
+SOURCING_WORKERS = int(os.getenv("SOURCING_WORKERS", "8"))
+_POOL = ThreadPoolExecutor(max_workers=SOURCING_WORKERS, thread_name_prefix="sourcing")
+
+# Background batches submitted with ?async=1. They get their own executor because each job
+# waits on _POOL tasks itself, and must not hold _POOL threads while doing so.
+# Job state is kept as one JSON file per job, so any worker process (or a restarted one) can report it.
+JOB_TTL_SECONDS = 3600
+JOBS_DIR = os.getenv("SOURCING_JOBS_DIR") or os.path.join(os.path.expanduser('~'), '.cache', 'sourcing-assistant', 'jobs')
+_JOB_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="sourcing-job")
+_JOB_ID_RE = re.compile(r'[0-9a-f]{32}')
+
+# Matches both '/spreadsheets/d/<id>' and the short '/d/<id>' form in a single scan
+_SHEET_URL_RE = re.compile(r'/(?:spreadsheets/)?d/([a-zA-Z0-9-_]+)')
+# Characters allowed in a bare 44-character sheet ID (ASCII only, unlike str.isalnum)
+_SHEET_ID_CHARS = frozenset(string.ascii_letters + string.digits + '-_')
+
 def extract_sheet_id_from_url(url_string):
     if not url_string:
         return None
     
-    match = re.search(r'/spreadsheets/d/([a-zA-Z0-9-_]+)', url_string)
-    if match:
-        return match.group(1)
-    
-    match = re.search(r'/d/([a-zA-Z0-9-_]+)', url_string)
+    match = _SHEET_URL_RE.search(url_string)
     if match:
         return match.group(1)
         
-    if re.fullmatch(r'[a-zA-Z0-9-_]{44}', url_string):
+    if len(url_string) == 44 and _SHEET_ID_CHARS.issuperset(url_string):
          return url_string
          
-    logger.warning(f"Could not parse a valid Google Sheet ID from '{url_string}'. It might be an invalid URL or ID format.")
+    logger.warning("Could not parse a valid Google Sheet ID from '%s'. It might be an invalid URL or ID format.", url_string)
     return None
 
-def process_sourcing_request(url, product_name, min_moq, max_moq, google_sheet_id):
-    logger.info(f"Processing URL: {url} for product: {product_name}, MOQ: {min_moq}-{max_moq}, Sheet ID: {google_sheet_id}")
-
-    # Default min_moq to 120 if not provided
-    if min_moq is None:
-        min_moq = 120
-        logger.info(f"min_moq was not provided, defaulting to {min_moq}")
+def _error_response(error_message):
+    return {
+        "error": error_message,
+        "rows_uploaded": 0,
+        "skus_found": 0,
+        "skus_after_filter": 0,
+        "price_tiers_count": 0,
+        "product_name": ''
+    }
 
+def _check_configuration(google_sheet_id):
+    """Returns an (error response, status code) pair if the server or request is not set up for processing, else None."""
     if not LOVBUY_API_KEY:
         error_msg = "Server configuration error: LOVBUY_API_KEY not set."
-        print(f"Error: {error_msg}")
+        logger.error(error_msg)
         return {"error": error_msg}, 500
 
     if not google_sheet_id: 
         error_msg = "Client error: Google Sheet ID is missing or invalid."
-        print(f"Error: {error_msg}")
+        logger.error(error_msg)
         return {"error": error_msg}, 400
 
     if not GOOGLE_APPLICATION_CREDENTIALS:
         error_msg = "Server configuration error: GOOGLE_APPLICATION_CREDENTIALS not set."
-        print(f"Error: {error_msg}")
+        logger.error(error_msg)
         return {"error": error_msg}, 500
 
-    lovbuy = LovbuyClient(LOVBUY_API_KEY)
-    response_data = {}
-    status_code = 200
+    return None
 
+def fetch_product_info(lovbuy, url):
+    """
+    Fetches the LovBuy product data for one URL.
+    Returns (product_info, None) on success, or (None, (response_data, status_code)) describing the failure.
+    """
     try:
         product_info = lovbuy.get_product_info_from_1688_url(url)
+    except Exception as e_lovbuy:
+        error_message = f"An error occurred while fetching product data from LovBuy for {url}: {e_lovbuy}"
+        logger.exception(error_message)
+        return None, (_error_response(error_message), 500)
+
+    if not product_info:
+        error_message = f"Failed to retrieve product information from LovBuy for URL: {url}"
+        logger.error(error_message)
+        return None, (_error_response(error_message), 400)
 
-        if product_info:
-            # Check if the API response contains an error
-            if 'status' in product_info and product_info['status'] != 200:
-                error_message = f"❌ API Error: {product_info.get('message', 'Unknown API error')}"
-                if 'status' in product_info:
-                    error_message += f"\nFull response: {product_info}"
-                print(error_message)
-                response_data = {
-                    "error": error_message,
-                    "rows_uploaded": 0,
-                    "skus_found": 0,
-                    "skus_after_filter": 0,
-                    "price_tiers_count": 0,
-                    "product_name": ''
-                }
-                status_code = 400
-                return response_data, status_code
-            
-            print(f"Successfully fetched product data from LovBuy for URL: {url}")
-            with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json', encoding='utf-8') as tmp_file:
-                json.dump(product_info, tmp_file, ensure_ascii=False, indent=2)
-                temp_product_data_path = tmp_file.name
-            
-            print(f"Product data temporarily saved to: {temp_product_data_path}")
-            print(f"Attempting to update Google Sheet... Product: {product_name}, MinMOQ: {min_moq}, MaxMOQ: {max_moq}")
-
-            try:
-                stats = run_sheet_update(
-                    product_data_path=temp_product_data_path,
-                    product_type_arg=product_name,
-                    min_moq_arg=min_moq,
-                    max_moq_arg=max_moq,
-                    source_url_arg=url,
-                    google_sheet_id_param=google_sheet_id
-                )
-                
-                # Create detailed success message with statistics
-                if stats and not stats.get('error'):
-                    skus_found = stats['skus_found']
-                    skus_after_filter = stats['skus_after_filter']
-                    rows_uploaded = stats['rows_uploaded']
-                    price_tiers = stats.get('price_tiers_count', 0)
-                    moq_groups = stats.get('moq_groups_count', 0)
-                    
-                    if skus_found > 0:
-                        # SKU-based product
-                        message = f"✅ '{stats['product_name']}' - {skus_found} SKUs found → {skus_after_filter} after filtering → {rows_uploaded} uploaded ({moq_groups} MOQ groups)"
-                    else:
-                        # Price-tier-based product (no individual SKUs)
-                        if price_tiers > 0:
-                            message = f"✅ '{stats['product_name']}' - {price_tiers} price variations found → {rows_uploaded} uploaded ({moq_groups} MOQ groups)"
-                        else:
-                            message = f"✅ '{stats['product_name']}' - {rows_uploaded} variants uploaded ({moq_groups} MOQ groups)"
-                else:
-                    message = f"⚠️ '{stats.get('product_name', 'Unknown Product')}': {stats.get('error', 'Unknown error')}"
-                
-                response_data = {
-                    "message": message,
-                    "product_name": stats.get('product_name', 'Unknown Product'),
-                    "source_url": url,
-                    "rows_uploaded": stats.get('rows_uploaded', 0),
-                    "skus_found": stats.get('skus_found', 0),
-                    "skus_after_filter": stats.get('skus_after_filter', 0),
-                    "price_tiers_count": stats.get('price_tiers_count', 0),
-                    "product_name": stats.get('product_name', '')
-                }
-                print(message)
-            except Exception as e_sheet:
-                error_message = f"An error occurred during Google Sheet update for {url}: {e_sheet}"
-                print(error_message)
-                response_data = {
-                    "error": error_message,
-                    "rows_uploaded": 0,
-                    "skus_found": 0,
-                    "skus_after_filter": 0,
-                    "price_tiers_count": 0,
-                    "product_name": ''
-                }
-                status_code = 500
-            finally:
-                if os.path.exists(temp_product_data_path):
-                    os.remove(temp_product_data_path)
-                    print(f"Temporary file {temp_product_data_path} removed.")
+    # Bail out on API-level errors before doing any Google Sheets work
+    api_error = LovbuyClient.get_api_error(product_info)
+    if api_error is not None:
+        error_message = f"❌ API Error: {api_error}"
+        error_message += f"\nFull response: {product_info}"
+        logger.error(error_message)
+        return None, (_error_response(error_message), 400)
 
+    logger.info("Successfully fetched product data from LovBuy for URL: %s", url)
+    return product_info, None
+
+def _stats_response(stats, url):
+    """Builds the per-URL response, with a detailed success message, from the sheet update statistics."""
+    if stats and not stats.get('error'):
+        skus_found = stats['skus_found']
+        skus_after_filter = stats['skus_after_filter']
+        rows_uploaded = stats['rows_uploaded']
+        price_tiers = stats.get('price_tiers_count', 0)
+        moq_groups = stats.get('moq_groups_count', 0)
+        
+        if skus_found > 0:
+            # SKU-based product
+            message = f"✅ '{stats['product_name']}' - {skus_found} SKUs found → {skus_after_filter} after filtering → {rows_uploaded} uploaded ({moq_groups} MOQ groups)"
         else:
-            error_message = f"Failed to retrieve product information from LovBuy for URL: {url}"
-            print(error_message)
-            response_data = {
-                "error": error_message,
-                "rows_uploaded": 0,
-                "skus_found": 0,
-                "skus_after_filter": 0,
-                "price_tiers_count": 0,
-                "product_name": ''
-            }
-            status_code = 400
+            # Price-tier-based product (no individual SKUs)
+            if price_tiers > 0:
+                message = f"✅ '{stats['product_name']}' - {price_tiers} price variations found → {rows_uploaded} uploaded ({moq_groups} MOQ groups)"
+            else:
+                message = f"✅ '{stats['product_name']}' - {rows_uploaded} variants uploaded ({moq_groups} MOQ groups)"
+    else:
+        message = f"⚠️ '{stats.get('product_name', 'Unknown Product')}': {stats.get('error', 'Unknown error')}"
+    
+    logger.info(message)
+    return {
+        "message": message,
+        "source_url": url,
+        "rows_uploaded": stats.get('rows_uploaded', 0),
+        "skus_found": stats.get('skus_found', 0),
+        "skus_after_filter": stats.get('skus_after_filter', 0),
+        "price_tiers_count": stats.get('price_tiers_count', 0),
+        "moq_groups_count": stats.get('moq_groups_count', 0),
+        "product_name": stats.get('product_name', '')
+    }
 
-    except Exception as e_lovbuy:
-        error_message = f"An error occurred while fetching product data from LovBuy for {url}: {e_lovbuy}"
-        print(error_message)
-        response_data = {
-            "error": error_message,
-            "rows_uploaded": 0,
-            "skus_found": 0,
-            "skus_after_filter": 0,
-            "price_tiers_count": 0,
-            "product_name": ''
-        }
-        status_code = 500
+def iter_sourcing_batch(urls, product_name, min_moq, max_moq, google_sheet_id):
+    """
+    Fetches all URLs from LovBuy concurrently, then writes every fetched product to the sheet
+    in a single batch so a multi-URL submission costs one append instead of one per URL.
+    Yields (index, response_data, status_code) per URL as soon as its outcome is known:
+    LovBuy failures as their fetch completes, sheet results once the shared write finishes.
+    """
+    logger.info("Processing %d URLs for product: %s, MOQ: %s-%s, Sheet ID: %s", len(urls), product_name, min_moq, max_moq, google_sheet_id)
+
+    # Default min_moq to 120 if not provided
+    if min_moq is None:
+        min_moq = 120
+        logger.info("min_moq was not provided, defaulting to %s", min_moq)
+
+    config_error = _check_configuration(google_sheet_id)
+    if config_error:
+        for i in range(len(urls)):
+            yield (i, *config_error)
+        return
+
+    futures = {_POOL.submit(fetch_product_info, _LOVBUY, url): i for i, url in enumerate(urls)}
+    fetched = {}
+    for future in as_completed(futures):
+        i = futures[future]
+        product_info, fetch_error = future.result()
+        if fetch_error:
+            yield (i, *fetch_error)
+        else:
+            fetched[i] = product_info
+    if not fetched:
+        return
+
+    # Write in input order so rows land in the sheet the way the links were entered
+    indices = sorted(fetched)
+    products = [(urls[i], fetched[i]) for i in indices]
+    logger.info("Attempting to update Google Sheet with %d products... Product: %s, MinMOQ: %s, MaxMOQ: %s", len(products), product_name, min_moq, max_moq)
+    try:
+        # Run the write on a pool thread so it reuses that thread's Sheets client
+        batch_stats = _POOL.submit(run_sheet_update_batch, products, product_name, min_moq, max_moq, google_sheet_id).result()
+    except Exception as e_sheet:
+        batch_stats = [e_sheet] * len(products)
+
+    for i, stats in zip(indices, batch_stats):
+        if isinstance(stats, Exception):
+            error_message = f"An error occurred during Google Sheet update for {urls[i]}: {stats}"
+            logger.error(error_message)
+            yield i, _error_response(error_message), 500
+        else:
+            yield i, _stats_response(stats, urls[i]), 200
+
+def process_sourcing_batch(urls, product_name, min_moq, max_moq, google_sheet_id):
+    """Runs iter_sourcing_batch to completion and returns a (response_data, status_code) pair per URL, in the order of urls."""
+    results = [None] * len(urls)
+    for i, response_data, status_code in iter_sourcing_batch(urls, product_name, min_moq, max_moq, google_sheet_id):
+        results[i] = (response_data, status_code)
+    return results
+
+def run_sourcing_batch(urls, product_name, min_moq, max_moq, google_sheet_id):
+    """Processes a batch and returns the aggregated /api/process body with its status code (207 if any URL failed)."""
+    batch_results = process_sourcing_batch(urls, product_name, min_moq, max_moq, google_sheet_id)
+    responses = [_result_record(url, response, status) for url, (response, status) in zip(urls, batch_results)]
     
-    return response_data, status_code
+    # Check if all requests were successful
+    all_success = all(r["status"] == "success" for r in responses)
+    status_code = 200 if all_success else 207  # 207 Multi-Status if some failed
+    
+    return {
+        "results": responses,
+        "message": f"Processed {len(responses)} URLs" + ("" if all_success else " (some failed)")
+    }, status_code
+
+def _job_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+def _write_job(job_id, state):
+    """Replaces the job's state file in one step, so readers in other processes never see a partial write."""
+    tmp_path = f"{_job_path(job_id)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, _job_path(job_id))
+
+def _prune_jobs():
+    """Deletes job files not updated for JOB_TTL_SECONDS."""
+    cutoff = time.time() - JOB_TTL_SECONDS
+    for entry in os.scandir(JOBS_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass  # Already removed by another worker
+
+def _run_job(job_id, fn, args):
+    try:
+        body, status_code = fn(*args)
+        state = {"status": "done", "status_code": status_code, "body": body}
+    except Exception as e_job:
+        logger.exception("Background job %s failed", job_id)
+        state = {"status": "failed", "status_code": 500, "error": str(e_job)}
+    _write_job(job_id, state)
+
+def submit_job(fn, *args):
+    """
+    Runs fn(*args) on this process's job executor and returns the id to poll it with.
+    The job's state is stored under JOBS_DIR; finished jobs are dropped JOB_TTL_SECONDS after they complete.
+    """
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    _prune_jobs()
+    job_id = uuid.uuid4().hex
+    _write_job(job_id, {"status": "pending"})
+    _JOB_EXECUTOR.submit(_run_job, job_id, fn, args)
+    return job_id
+
+def read_job(job_id):
+    """Returns the stored state of job_id, or None if it is unknown or expired."""
+    if not _JOB_ID_RE.fullmatch(job_id):
+        return None
+    try:
+        if time.time() - os.path.getmtime(_job_path(job_id)) > JOB_TTL_SECONDS:
+            return None
+        with open(_job_path(job_id), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _result_record(url, response, status):
+    """Shapes one URL's outcome for the /api/process response."""
+    # Extract statistics from the response if available
+    stats = response if isinstance(response, dict) and not response.get("error") else {}
+    return {
+        "url": url,
+        "status": "success" if status == 200 else "error",
+        "message": response.get("message") or response.get("error"),
+        "product_name": response.get("product_name", "Unknown Product"),
+        "source_url": response.get("source_url", url),
+        "rows_uploaded": stats.get("rows_uploaded", 0),
+        "skus_found": stats.get("skus_found", 0),
+        "price_tiers_count": stats.get("price_tiers_count", 0),
+        "moq_groups_count": stats.get("moq_groups_count", 0),
+        "status_code": status
+    }
 
 @app.route('/')
 def serve_index():
-    return send_from_directory(app.static_folder, 'index.html')
+    response = send_from_directory(app.static_folder, 'index.html')
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
 
 @app.route('/api/process', methods=['POST'])
 def handle_api_process():
@@ -210,39 +328,37 @@ def handle_api_process():
     except ValueError:
         return jsonify({"error": "Invalid 'minMoq' or 'maxMoq' value. Must be an integer."}), 400
 
-    # Process all URLs and collect responses
-    responses = []
-    for url in urls:
-        url = url.strip()
-        if not url:
-            continue
-            
-        response, status = process_sourcing_request(url, product_name, min_moq, max_moq, parsed_google_sheet_id)
-        
-        # Extract statistics from the response if available
-        stats = response if isinstance(response, dict) and not response.get("error") else {}
-        
-        responses.append({
-            "url": url,
-            "status": "success" if status == 200 else "error",
-            "message": response.get("message") or response.get("error"),
-            "product_name": response.get("product_name", "Unknown Product"),
-            "source_url": response.get("source_url", url),
-            "rows_uploaded": stats.get("rows_uploaded", 0),
-            "skus_found": stats.get("skus_found", 0),
-            "price_tiers_count": stats.get("price_tiers_count", 0),
-            "moq_groups_count": stats.get("moq_groups_count", 0),
-            "status_code": status
-        })
-    
-    # Check if all requests were successful
-    all_success = all(r["status"] == "success" for r in responses)
-    status_code = 200 if all_success else 207  # 207 Multi-Status if some failed
-    
-    return jsonify({
-        "results": responses,
-        "message": f"Processed {len(responses)} URLs" + ("" if all_success else " (some failed)")
-    }), status_code
+    # Drop blank and repeated URLs (keeping input order), then fetch concurrently and write once
+    urls = list(dict.fromkeys(url.strip() for url in urls if url.strip()))
+
+    # ?stream=1 sends one NDJSON line per URL as soon as its result is ready
+    if request.args.get('stream') == '1':
+        def generate():
+            for i, response, status in iter_sourcing_batch(urls, product_name, min_moq, max_moq, parsed_google_sheet_id):
+                yield json.dumps({"index": i, **_result_record(urls[i], response, status)}) + "\n"
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    # ?async=1 queues the batch and answers 202 right away; poll /api/jobs/<job_id> for the result
+    if request.args.get('async') == '1':
+        job_id = submit_job(run_sourcing_batch, urls, product_name, min_moq, max_moq, parsed_google_sheet_id)
+        return jsonify({"job_id": job_id, "status": "pending"}), 202
+
+    body, status_code = run_sourcing_batch(urls, product_name, min_moq, max_moq, parsed_google_sheet_id)
+    return jsonify(body), status_code
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def handle_job_status(job_id):
+    job = read_job(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown or expired job: '{job_id}'"}), 404
+
+    if job["status"] == "pending":
+        return jsonify({"job_id": job_id, "status": "pending"}), 200
+    if job["status"] == "failed":
+        return jsonify({"job_id": job_id, "status": "failed", "error": job["error"]}), job["status_code"]
+    return jsonify({"job_id": job_id, "status": "done", **job["body"]}), job["status_code"]
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5000)
+    # Development server only; in production run wsgi:application under Gunicorn (see README).
+    # Set FLASK_DEBUG=1 for the debugger and auto-reloader.
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1", port=5000, threaded=True)
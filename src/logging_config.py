@@ -1,12 +1,44 @@
 import os
+import queue
+import atexit
 import logging
-from logging.handlers import TimedRotatingFileHandler
-from datetime import datetime, timedelta
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+
+class ProcessLocalQueueHandler(QueueHandler):
+    """
+    Queues records for a QueueListener that writes them to targets on a background thread.
+    The listener is started on the first record in each process, so a worker forked after
+    setup_logging (e.g. under gunicorn --preload) gets its own writer thread instead of
+    queueing into one that only exists in the parent.
+    """
+
+    def __init__(self, *targets):
+        super().__init__(queue.SimpleQueue())
+        self._targets = targets
+        self._listener = None
+        self._listener_pid = None
+        atexit.register(self.stop_listener)  # Flushes queued records on exit
+
+    def enqueue(self, record):
+        # Called under the handler lock, so only one thread starts the listener
+        if self._listener_pid != os.getpid():
+            self.queue = queue.SimpleQueue()
+            self._listener = QueueListener(self.queue, *self._targets, respect_handler_level=True)
+            self._listener.start()
+            self._listener_pid = os.getpid()
+        super().enqueue(record)
+
+    def stop_listener(self):
+        if self._listener is not None and self._listener_pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._listener_pid = None
 
 def setup_logging():
     """
     Set up logging configuration with both console and file handlers.
     Logs are rotated daily and kept for 14 days.
+    Records are handed to a background thread through a queue, so request threads never block on console or file writes.
     """
     # Create logs directory if it doesn't exist
     logs_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'logs')
@@ -32,7 +64,7 @@ def setup_logging():
         interval=1,
         backupCount=14,  # Keep logs for 14 days
         encoding='utf-8',
-        delay=False
+        delay=True  # Open the file on the first emitted record
     )
     file_handler.setLevel(logging.INFO)
     
@@ -45,9 +77,8 @@ def setup_logging():
     console_handler.setFormatter(formatter)
     file_handler.setFormatter(formatter)
     
-    # Add handlers
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    # Add handlers behind a queue; the listener thread does the actual writing
+    logger.addHandler(ProcessLocalQueueHandler(console_handler, file_handler))
     
     # Log start of application
     logger.info("=" * 50)
@@ -2,37 +2,86 @@ import os
 import requests
 import re
 import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # Optional speedup (see the "speedups" extra in pyproject.toml)
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# '/offer/<id>.html' or '/<id>.html' in the path, or an 'offerId=<id>' / 'offer_id=<id>' query parameter
+_ITEM_ID_RE = re.compile(r"/(?:offer/)?(\d+)\.html|[?&]offer_?id=(\d+)", re.IGNORECASE)
 
 class LovbuyClient:
     BASE_URL = "https://www.lovbuy.com/"
     API_V2_1688_ENDPOINT = "1688api/getproductinfo2.php"
 
+    # Successful product lookups are cached per (item_id, lang) so repeated URLs within
+    # the TTL don't hit the paid endpoint again. Shared by all clients and worker threads.
+    CACHE_MAX_SIZE = 1024
+    _response_cache = OrderedDict()
+    _cache_lock = threading.Lock()
+    # Lookups currently in flight, keyed like the cache, so concurrent callers asking for
+    # the same item_id (e.g. URLs differing only in query string) share one request
+    _inflight = {}
+    _inflight_lock = threading.Lock()
+
     def __init__(self, api_key):
         self.api_key = api_key
         if not self.api_key:
-            print("ERROR: LOVBUY_API_KEY not found in environment variables.")
+            logger.error("LOVBUY_API_KEY not found in environment variables.")
             raise ValueError("API key is required.")
         
-        print(f"LovbuyClient initialized for 1688 API v2.")
-        print(f"Using API Key: {self.api_key[:4]}...{self.api_key[-4:]}")
-        print(f"Target API URL: {self.BASE_URL}{self.API_V2_1688_ENDPOINT}")
-        print("Parameters: 'key' (API Key), 'item_id' (extracted from URL), 'lang' (optional, default 'en').")
-        print("Refer to: https://www.lovbuy.com/api5.html for '1688 API /Get a product info V.2'")
+        logger.debug("LovbuyClient initialized for 1688 API v2.")
+        logger.debug("Using API Key: %s...%s", self.api_key[:4], self.api_key[-4:])
+        logger.debug("Target API URL: %s%s", self.BASE_URL, self.API_V2_1688_ENDPOINT)
+        logger.debug("Parameters: 'key' (API Key), 'item_id' (extracted from URL), 'lang' (optional, default 'en').")
+        logger.debug("Refer to: https://www.lovbuy.com/api5.html for '1688 API /Get a product info V.2'")
+
+        # One pooled keep-alive session per client so repeated calls skip the TCP/TLS handshake.
+        # Transient failures are retried; raise_on_status=False keeps returning the final
+        # (error) JSON body so its details can still be reported.
+        self._session = requests.Session()
+        retries = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retries)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        # Ask for compressed JSON. make_headers only advertises codecs urllib3 can decode here,
+        # so 'br' is included only when the optional brotli package is installed.
+        self._session.headers.update({
+            "Accept": "application/json",
+            "Accept-Encoding": make_headers(accept_encoding=True)["accept-encoding"],
+        })
 
     def _request(self, method, endpoint, params=None, data=None, headers=None):
         url = f"{self.BASE_URL}{endpoint}"
-        print(f"\nAttempting {method} request to: {url}")
+        logger.debug("Attempting %s request to: %s", method, url)
         if params:
-            print(f"With parameters: {params}")
+            logger.debug("With parameters: %s", params)
         
         try:
-            response = requests.request(method, url, params=params, json=data, headers=headers)
-            print(f"Response Status Code: {response.status_code}")
+            response = self._session.request(method, url, params=params, json=data, headers=headers)
+            logger.debug("Response Status Code: %s", response.status_code)
             
             # Try to parse JSON response regardless of status code
             try:
-                json_response = response.json()
-                print(f"Response JSON: {json_response}")
+                json_response = self._parse_json(response)
+                logger.debug("Response JSON: %s", json_response)
                 
                 # If status code indicates success, return the response
                 if response.status_code == 200:
@@ -43,27 +92,34 @@ class LovbuyClient:
                 return json_response
                 
             except ValueError as json_err:
-                print(f"JSON decode error: {json_err}")
-                print(f"Response content: {response.text}")
+                logger.error("JSON decode error: %s", json_err)
+                logger.error("Response content: %s", response.text)
                 # If we can't parse JSON, raise the HTTP error
                 response.raise_for_status()
                 
         except requests.exceptions.HTTPError as http_err:
-            print(f"HTTP error occurred: {http_err}")
-            print(f"Response content: {response.text}") 
+            logger.error("HTTP error occurred: %s", http_err)
+            logger.error("Response content: %s", response.text)
         except requests.exceptions.RequestException as req_err:
-            print(f"Request exception occurred: {req_err}")
+            logger.error("Request exception occurred: %s", req_err)
             
         return None
 
+    @staticmethod
+    def _parse_json(response):
+        """Decodes the raw response bytes with orjson when available, falling back to requests' parser."""
+        if orjson is not None:
+            try:
+                return orjson.loads(response.content)
+            except orjson.JSONDecodeError:
+                pass  # e.g. a non-UTF-8 body; let requests detect the encoding
+        return response.json()
+
     def _extract_item_id_from_url(self, product_url):
-        match = re.search(r"offer/(\d+)\.html", product_url)
+        match = _ITEM_ID_RE.search(product_url)
         if match:
-            return match.group(1)
-        match = re.search(r"/(\d+)\.html", product_url) 
-        if match:
-            return match.group(1)
-        print(f"Could not extract item_id from URL: {product_url}")
+            return match.group(1) or match.group(2)
+        logger.warning("Could not extract item_id from URL: %s", product_url)
         return None
 
     def get_product_info_from_1688_url(self, product_url, lang="en"):
@@ -71,12 +127,92 @@ class LovbuyClient:
         if not item_id:
             return None
 
-        params = {
-            "key": self.api_key,
-            "item_id": item_id,
-            "lang": lang
-        }
-        return self._request("GET", self.API_V2_1688_ENDPOINT, params=params)
+        cache_key = (item_id, lang)
+        cached = self._get_cached_response(cache_key)
+        if cached is not None:
+            logger.info("Using cached LovBuy response for item_id %s", item_id)
+            return cached
+
+        with self._inflight_lock:
+            pending = self._inflight.get(cache_key)
+            is_owner = pending is None
+            if is_owner:
+                pending = Future()
+                self._inflight[cache_key] = pending
+        if not is_owner:
+            logger.debug("Waiting for in-flight LovBuy request for item_id %s", item_id)
+            return pending.result()
+
+        try:
+            # The previous owner may have cached the response just before we registered
+            response = self._get_cached_response(cache_key)
+            if response is None:
+                params = {
+                    "key": self.api_key,
+                    "item_id": item_id,
+                    "lang": lang
+                }
+                response = self._request("GET", self.API_V2_1688_ENDPOINT, params=params)
+                if self._is_successful_response(response):
+                    self._store_cached_response(cache_key, response)
+            pending.set_result(response)
+            return response
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[cache_key]
+
+    @staticmethod
+    def get_api_error(response):
+        """
+        Returns the error message if the response is a LovBuy error payload, otherwise None.
+        LovBuy reports failures in the JSON body ('status', 'code' or 'error') rather than via HTTP status.
+        """
+        if not isinstance(response, dict):
+            return "Unexpected response format from LovBuy API"
+        status = response.get('status', 200)
+        code = response.get('code')
+        if response.get('error') or status != 200 or code not in (None, 0, 200, "0", "200"):
+            return str(response.get('message') or response.get('error') or 'Unknown API error')
+        return None
+
+    @classmethod
+    def _is_successful_response(cls, response):
+        """Only plain product payloads are cached; errors and empty responses are retried."""
+        return bool(response) and cls.get_api_error(response) is None
+
+    @staticmethod
+    def cache_ttl_seconds():
+        """LOVBUY_CACHE_TTL is read on each use, since .env is only loaded after this module is imported."""
+        return int(os.getenv("LOVBUY_CACHE_TTL", "3600"))
+
+    @classmethod
+    def _get_cached_response(cls, cache_key):
+        ttl_seconds = cls.cache_ttl_seconds()
+        if ttl_seconds <= 0:
+            return None
+        with cls._cache_lock:
+            entry = cls._response_cache.get(cache_key)
+            if entry is None:
+                return None
+            stored_at, response = entry
+            if time.monotonic() - stored_at > ttl_seconds:
+                del cls._response_cache[cache_key]
+                return None
+            cls._response_cache.move_to_end(cache_key)
+            return response
+
+    @classmethod
+    def _store_cached_response(cls, cache_key, response):
+        if cls.cache_ttl_seconds() <= 0:
+            return
+        with cls._cache_lock:
+            cls._response_cache[cache_key] = (time.monotonic(), response)
+            cls._response_cache.move_to_end(cache_key)
+            while len(cls._response_cache) > cls.CACHE_MAX_SIZE:
+                cls._response_cache.popitem(last=False)
 
 if __name__ == "__main__":
     import os
@@ -1,47 +1,77 @@
 import os
 import json
+import math
+import bisect
 import datetime
 import logging
+import threading
+import functools
+import itertools
+import hashlib
+import time
+import random
 from urllib.parse import urlparse, urlunparse
 from dotenv import load_dotenv
+import httplib2
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+try:
+    import orjson  # Optional speedup (see the "speedups" extra in pyproject.toml)
+except ImportError:
+    orjson = None
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
 # --- Configuration ---
 load_dotenv(override=True)
 
-# Environment variables
-# GOOGLE_SHEET_ID_FROM_ENV = os.getenv("GOOGLE_SHEET_ID") # No longer primary source for run_sheet_update
-GOOGLE_CREDENTIALS_PATH_FROM_ENV = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-
-# logger.debug(f"GOOGLE_SHEET_ID from .env (raw): {{GOOGLE_SHEET_ID_FROM_ENV}}") # Commented out
-logger.debug(f"GOOGLE_APPLICATION_CREDENTIALS from .env (raw): {GOOGLE_CREDENTIALS_PATH_FROM_ENV}")
-
 # Global GOOGLE_SHEET_ID processing is removed as run_sheet_update will take it as a parameter.
 # GOOGLE_SHEET_ID = None # Ensuring it's not used globally by mistake.
 
-# Process GOOGLE_CREDENTIALS_PATH
-# If the path from .env starts with './', make it absolute relative to the script's directory or CWD.
-# For simplicity, we'll assume it's relative to the CWD where the script is run.
-if GOOGLE_CREDENTIALS_PATH_FROM_ENV and GOOGLE_CREDENTIALS_PATH_FROM_ENV.startswith('./'):
-    # Construct absolute path from CWD. Note: os.path.abspath handles './' correctly.
-    GOOGLE_CREDENTIALS_PATH = os.path.abspath(GOOGLE_CREDENTIALS_PATH_FROM_ENV)
-    logger.debug(f"Resolved GOOGLE_APPLICATION_CREDENTIALS (relative to CWD): {GOOGLE_CREDENTIALS_PATH}")
-elif GOOGLE_CREDENTIALS_PATH_FROM_ENV:
-    GOOGLE_CREDENTIALS_PATH = GOOGLE_CREDENTIALS_PATH_FROM_ENV
-    logger.debug(f"Using GOOGLE_APPLICATION_CREDENTIALS as is (absolute or from global env): {GOOGLE_CREDENTIALS_PATH}")
-else:
-    GOOGLE_CREDENTIALS_PATH = None
+def resolve_credentials_path():
+    """
+    Returns the service account key path from GOOGLE_APPLICATION_CREDENTIALS, or None if it is not set.
+    Resolved when credentials are first loaded rather than at import, so importing this module stays side-effect free.
+    """
+    credentials_path_from_env = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+    logger.debug(f"GOOGLE_APPLICATION_CREDENTIALS from .env (raw): {credentials_path_from_env}")
+
+    # If the path from .env starts with './', make it absolute relative to the CWD where the script is run.
+    if credentials_path_from_env and credentials_path_from_env.startswith('./'):
+        # Construct absolute path from CWD. Note: os.path.abspath handles './' correctly.
+        credentials_path = os.path.abspath(credentials_path_from_env)
+        logger.debug(f"Resolved GOOGLE_APPLICATION_CREDENTIALS (relative to CWD): {credentials_path}")
+        return credentials_path
+    if credentials_path_from_env:
+        logger.debug(f"Using GOOGLE_APPLICATION_CREDENTIALS as is (absolute or from global env): {credentials_path_from_env}")
+        return credentials_path_from_env
     logger.warning("GOOGLE_APPLICATION_CREDENTIALS not found in .env or environment.")
+    return None
 
 # Script configurations
 TARGET_SHEET_NAME = "Sheet1"  # The name of the sheet to update
 EXPECTED_HEADER = ["id", "photo", "price 1688", "price cust", "profit", "moq", "info", "material", "link"]
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+SHEETS_HTTP_TIMEOUT = 60  # Seconds per Sheets API call
+SHEETS_MAX_ATTEMPTS = 6  # Tries per Sheets API call when Google answers with a quota or server error
+SHEETS_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Upper bound on Sheets API calls in flight at once in this process, so parallel uploads to
+# different spreadsheets don't burst past the per-minute quota
+SHEETS_MAX_CONCURRENT_CALLS = int(os.getenv("SHEETS_MAX_CONCURRENT_CALLS", "8"))
+# Client-side pacing of Sheets reads and writes per process, matching Google's default per-user quota
+# of 60 each per minute, so bursts wait here instead of collecting 429s; 0 disables
+SHEETS_READS_PER_MINUTE = int(os.getenv("SHEETS_READS_PER_MINUTE", "60"))
+SHEETS_WRITES_PER_MINUTE = int(os.getenv("SHEETS_WRITES_PER_MINUTE", "60"))
+# Identical rows sent to the same spreadsheet again within this many seconds (e.g. a double submit) are skipped.
+# Off by default (0): re-uploading a product on purpose must still append it. Tracked per process.
+UPLOAD_DEDUP_SECONDS = int(os.getenv("UPLOAD_DEDUP_SECONDS", "0"))
+HEADER_CELL_FORMAT = {'textFormat': {'bold': True}, 'horizontalAlignment': 'CENTER'}  # Shared by every header cell
+IMAGE_FORMULA_TEMPLATE = '=HYPERLINK("{url}", IMAGE("{url}"))'  # Clickable thumbnail for the 'photo' column
+PROFIT_FORMULA_TEMPLATE = '=IF(AND(ISNUMBER(D{row}),ISNUMBER(C{row})),D{row}-C{row},"")'  # 'price cust' minus 'price 1688'
 
 # --- Utility Functions ---
 
@@ -62,53 +92,281 @@ def try_convert_to_float(value):
         else:
             return float(value)
     except (ValueError, TypeError):
-        logging.warning(f"Could not convert '{value}' to float, returning original value")
+        logger.warning(f"Could not convert '{value}' to float, returning original value")
         return value
 
+def to_cell_data(value):
+    """
+    Converts a row value to Sheets CellData the way valueInputOption=USER_ENTERED would read it:
+    '=...' strings become formulas, numbers and numeric strings become numbers, anything else is text.
+    """
+    if value is None or value == '':
+        return {}
+    if isinstance(value, bool):
+        return {'userEnteredValue': {'boolValue': value}}
+    if isinstance(value, (int, float)):
+        return {'userEnteredValue': {'numberValue': value}}
+
+    text = str(value)
+    if text.startswith('='):
+        return {'userEnteredValue': {'formulaValue': text}}
+    try:
+        number = float(text)
+    except ValueError:
+        return {'userEnteredValue': {'stringValue': text}}
+    if math.isfinite(number):
+        return {'userEnteredValue': {'numberValue': number}}
+    return {'userEnteredValue': {'stringValue': text}}
+
+def build_column_width_requests(sheet_id, widths):
+    """
+    Builds updateDimensionProperties requests for widths, a {column index: pixels} dict.
+    Adjacent columns with the same width share one request.
+    """
+    runs = []  # [start, end, pixels]
+    for column in sorted(widths):
+        pixels = widths[column]
+        if runs and runs[-1][1] == column and runs[-1][2] == pixels:
+            runs[-1][1] = column + 1
+        else:
+            runs.append([column, column + 1, pixels])
+    return [
+        {
+            'updateDimensionProperties': {
+                'range': {'sheetId': sheet_id, 'dimension': 'COLUMNS', 'startIndex': start, 'endIndex': end},
+                'properties': {'pixelSize': pixels},
+                'fields': 'pixelSize'
+            }
+        }
+        for start, end, pixels in runs
+    ]
+
 # --- Google Sheets Helper Functions ---
 
+class TokenBucket:
+    """
+    Allows up to per_minute acquisitions per minute, in bursts of at most per_minute.
+    acquire() reserves a token and sleeps until it is due, so concurrent callers are spaced out in arrival order.
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0  # Tokens per second
+        self.capacity = float(per_minute)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1  # May go negative: later callers queue behind this reservation
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            logger.info(f"Pacing Sheets API calls; waiting {delay:.1f}s.")
+            time.sleep(delay)
+
+_sheets_read_bucket = TokenBucket(SHEETS_READS_PER_MINUTE)
+_sheets_write_bucket = TokenBucket(SHEETS_WRITES_PER_MINUTE)
+_sheets_call_slots = threading.BoundedSemaphore(max(1, SHEETS_MAX_CONCURRENT_CALLS))
+
+def execute_with_retry(request, idempotent=True):
+    """
+    Executes a googleapiclient request, retrying quota (429) and server (5xx) errors with exponential
+    backoff and jitter, honouring Retry-After when Google sends it.
+    Pass idempotent=False for writes that must not be applied twice (e.g. row inserts): those are only
+    retried on 429, where the request is known to have been rejected.
+    At most SHEETS_MAX_CONCURRENT_CALLS calls run at once; the slot is released while backing off.
+    Every attempt first takes a token from the read (GET) or write bucket.
+    """
+    bucket = _sheets_read_bucket if request.method == 'GET' else _sheets_write_bucket
+    for attempt in range(SHEETS_MAX_ATTEMPTS):
+        bucket.acquire()
+        try:
+            with _sheets_call_slots:
+                return request.execute()
+        except HttpError as error:
+            status = error.resp.status
+            retryable = status == 429 or (idempotent and status in SHEETS_RETRY_STATUSES)
+            if not retryable or attempt == SHEETS_MAX_ATTEMPTS - 1:
+                raise
+            try:
+                delay = float(error.resp.get('retry-after'))
+            except (TypeError, ValueError):
+                delay = min(2 ** attempt + random.random(), 32)
+            logger.warning(f"Sheets API returned {status}; retrying in {delay:.1f}s (attempt {attempt + 2}/{SHEETS_MAX_ATTEMPTS}).")
+            time.sleep(delay)
+
+# Credentials are loaded once per process; google-auth refreshes the access token when it expires.
+# Service objects wrap a non-thread-safe httplib2 transport, so each worker thread keeps its own.
+_credentials = None
+_credentials_lock = threading.Lock()
+_thread_local = threading.local()
+
+def get_google_credentials():
+    """Loads the service account credentials on first use and returns the shared instance."""
+    global _credentials
+    if _credentials is None:
+        with _credentials_lock:
+            if _credentials is None:
+                credentials_path = resolve_credentials_path()
+                if not credentials_path:
+                    raise ValueError("GOOGLE_APPLICATION_CREDENTIALS environment variable not set or key file path is missing.")
+                if not os.path.exists(credentials_path):
+                    raise FileNotFoundError(f"Google credentials file not found at: {credentials_path}")
+                _credentials = service_account.Credentials.from_service_account_file(
+                    credentials_path, scopes=SCOPES)
+    return _credentials
+
 def get_google_sheets_service():
-    """Initializes and returns the Google Sheets API service client."""
-    if not GOOGLE_CREDENTIALS_PATH:
-        raise ValueError("GOOGLE_APPLICATION_CREDENTIALS environment variable not set or key file path is missing.")
-    if not os.path.exists(GOOGLE_CREDENTIALS_PATH):
-        raise FileNotFoundError(f"Google credentials file not found at: {GOOGLE_CREDENTIALS_PATH}")
-    
-    creds = service_account.Credentials.from_service_account_file(
-        GOOGLE_CREDENTIALS_PATH, scopes=SCOPES)
-    service = build('sheets', 'v4', credentials=creds)
+    """Returns the Google Sheets API service client for the current thread, building it on first use."""
+    service = getattr(_thread_local, 'service', None)
+    if service is None:
+        # The authorized httplib2 transport keeps its HTTPS connection alive between calls and
+        # requests gzip responses; the timeout stops a stalled call from hanging a worker.
+        http = AuthorizedHttp(get_google_credentials(), http=httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT))
+        # Use the discovery document bundled with google-api-python-client instead of fetching it,
+        # and skip the discovery file cache, which only applies to fetched documents
+        service = build('sheets', 'v4', http=http, static_discovery=True, cache_discovery=False)
+        _thread_local.service = service
     return service
 
+_spreadsheet_locks = {}
+_spreadsheet_locks_lock = threading.Lock()
+
+def _get_spreadsheet_lock(spreadsheet_id):
+    """Returns the lock that serializes row inserts into one spreadsheet within this process."""
+    with _spreadsheet_locks_lock:
+        return _spreadsheet_locks.setdefault(spreadsheet_id, threading.Lock())
+
+def _fetch_sheet_state(service, spreadsheet_id, sheet_name):
+    """
+    Reads a tab's ID, frozen row count and header row with one spreadsheets.get.
+    Returns (sheet_id, frozen_row_count, header_values); sheet_id is None when the tab does not exist,
+    and the other two are None when they could not be read.
+    """
+    try:
+        sheet_metadata = execute_with_retry(service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            ranges=[f"{sheet_name}!1:1"],
+            includeGridData=True,
+            fields='sheets(properties(sheetId,title,gridProperties/frozenRowCount),data/rowData/values/formattedValue)'
+        ))
+    except HttpError as error:
+        # A range naming a missing tab is rejected as unparseable; look the tabs up without it
+        if error.resp.status != 400:
+            logger.error(f"An API error occurred while fetching sheet metadata for spreadsheet '{spreadsheet_id}': {error}")
+            raise
+        return get_sheet_id_by_name(service, spreadsheet_id, sheet_name), None, None
+
+    for sheet in sheet_metadata.get('sheets', []):
+        properties = sheet.get('properties', {})
+        if properties.get('title') != sheet_name:
+            continue
+        row_data = (sheet.get('data') or [{}])[0].get('rowData') or [{}]
+        header_values = [cell.get('formattedValue', '') for cell in row_data[0].get('values', [])]
+        # Match values.get, which drops trailing empty cells
+        while header_values and header_values[-1] == '':
+            header_values.pop()
+        frozen_row_count = properties.get('gridProperties', {}).get('frozenRowCount', 0)
+        return properties.get('sheetId'), frozen_row_count, header_values
+    logger.warning(f"Sheet named '{sheet_name}' not found in spreadsheet '{spreadsheet_id}'.")
+    return None, None, None
+
 def get_sheet_id_by_name(service, spreadsheet_id, sheet_name):
     """Gets the ID of a sheet by its name."""
     try:
-        sheet_metadata = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+        # Only the tab titles and IDs are needed, not the full spreadsheet metadata
+        sheet_metadata = execute_with_retry(service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id, fields='sheets(properties(sheetId,title))'))
         sheets = sheet_metadata.get('sheets', [])
         for sheet in sheets:
             if sheet.get('properties', {}).get('title') == sheet_name:
                 return sheet.get('properties', {}).get('sheetId')
-        print(f"Warning: Sheet named '{sheet_name}' not found in spreadsheet '{spreadsheet_id}'.")
+        logger.warning(f"Sheet named '{sheet_name}' not found in spreadsheet '{spreadsheet_id}'.")
         return None # Return None if specific sheet not found
     except HttpError as error:
-        print(f"An API error occurred while fetching sheet metadata for spreadsheet '{spreadsheet_id}': {error}")
+        logger.error(f"An API error occurred while fetching sheet metadata for spreadsheet '{spreadsheet_id}': {error}")
         raise
 
-def ensure_header_and_freeze(service, spreadsheet_id, sheet_id, sheet_name, header_values):
-    """Ensures the header row is present, frozen, bolded, and sets specific column widths."""
+# Sheets whose header is known to be in place, so later runs can skip reading row 1.
+# Set FORCE_HEADER_CHECK=1 to always check (e.g. after editing a header by hand).
+HEADER_MARKER_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'sourcing-assistant', 'header_ok.json')
+_header_markers = None
+_header_markers_lock = threading.Lock()
+
+def _load_header_markers():
+    """Returns the {spreadsheet_id:sheet_id: header} markers, reading the marker file on first use. Call with the lock held."""
+    global _header_markers
+    if _header_markers is None:
+        try:
+            with open(HEADER_MARKER_PATH, 'r', encoding='utf-8') as f:
+                _header_markers = json.load(f)
+        except (OSError, ValueError):
+            _header_markers = {}
+    return _header_markers
+
+def is_header_known(spreadsheet_id, sheet_id, header_values):
+    if os.getenv("FORCE_HEADER_CHECK") == "1":
+        return False
+    with _header_markers_lock:
+        return _load_header_markers().get(f"{spreadsheet_id}:{sheet_id}") == list(header_values)
+
+def remember_header(spreadsheet_id, sheet_id, header_values):
+    """Records that the sheet has the given header. Failing to write the marker file only costs a header check next time."""
+    with _header_markers_lock:
+        markers = _load_header_markers()
+        key = f"{spreadsheet_id}:{sheet_id}"
+        if markers.get(key) == list(header_values):
+            return
+        markers[key] = list(header_values)
+        try:
+            os.makedirs(os.path.dirname(HEADER_MARKER_PATH), exist_ok=True)
+            temp_path = f"{HEADER_MARKER_PATH}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(markers, f)
+            os.replace(temp_path, HEADER_MARKER_PATH)
+        except OSError as e:
+            logger.warning(f"Could not write header marker file '{HEADER_MARKER_PATH}': {e}")
+
+def ensure_header_and_freeze(service, spreadsheet_id, sheet_id, sheet_name, header_values, current_header=None, frozen_row_count=None):
+    """
+    Checks the header row and returns the batchUpdate requests that write, freeze and bold it and set
+    the A, B, G and H column widths, or an empty list when it is already in place.
+    Pass current_header/frozen_row_count from _fetch_sheet_state to skip reading row 1 again.
+    The requests are sent with the row upload; call remember_header once they have been applied.
+    """
+    if is_header_known(spreadsheet_id, sheet_id, header_values):
+        logger.debug(f"Header for '{sheet_name}' (ID: {sheet_id}) already verified; skipping check.")
+        return []
+
     try:
-        # Check current header
-        range_to_check = f"{sheet_name}!1:1"
-        result = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range_to_check).execute()
-        current_header = result.get('values', [[]])[0]
+        if current_header is None:
+            # Check current header
+            range_to_check = f"{sheet_name}!1:1"
+            result = execute_with_retry(service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range_to_check, fields='values'))
+            current_header = result.get('values', [[]])[0]
+
+        freeze_request = {
+            'updateSheetProperties': {
+                'properties': {
+                    'sheetId': sheet_id,
+                    'gridProperties': {'frozenRowCount': 1}
+                },
+                'fields': 'gridProperties.frozenRowCount'
+            }
+        }
 
         if current_header != header_values:
-            print(f"Header mismatch or not found. Updating header in '{sheet_name}'.")
+            logger.info(f"Header mismatch or not found. Updating header in '{sheet_name}'.")
             requests_batch = [
                 {
                     'updateCells': {
                         'rows': [{
-                            'values': [{'userEnteredValue': {'stringValue': val}, 
-                                        'userEnteredFormat': {'textFormat': {'bold': True}, 'horizontalAlignment': 'CENTER'}} 
+                            'values': [{'userEnteredValue': {'stringValue': val}, 'userEnteredFormat': HEADER_CELL_FORMAT}
                                        for val in header_values]
                         }],
                         'fields': 'userEnteredValue,userEnteredFormat(textFormat,horizontalAlignment)',
@@ -121,75 +379,27 @@ def ensure_header_and_freeze(service, spreadsheet_id, sheet_id, sheet_name, head
                         }
                     }
                 },
-                {
-                    'updateSheetProperties': {
-                        'properties': {
-                            'sheetId': sheet_id,
-                            'gridProperties': {'frozenRowCount': 1}
-                        },
-                        'fields': 'gridProperties.frozenRowCount'
-                    }
-                },
-                {
-                    'updateDimensionProperties': {
-                        'range': {
-                            'sheetId': sheet_id,
-                            'dimension': 'COLUMNS',
-                            'startIndex': 0,  # Column A (id)
-                            'endIndex': 1
-                        },
-                        'properties': {'pixelSize': 200},
-                        'fields': 'pixelSize'
-                    }
-                },
-                {
-                    'updateDimensionProperties': {
-                        'range': {
-                            'sheetId': sheet_id,
-                            'dimension': 'COLUMNS',
-                            'startIndex': 1,  # Column B (photo)
-                            'endIndex': 2
-                        },
-                        'properties': {'pixelSize': 200},
-                        'fields': 'pixelSize'
-                    }
-                },
-                {
-                    'updateDimensionProperties': { # info column (G)
-                        'range': {
-                            'sheetId': sheet_id,
-                            'dimension': 'COLUMNS',
-                            'startIndex': 6, 
-                            'endIndex': 7
-                        },
-                        'properties': {'pixelSize': 150},
-                        'fields': 'pixelSize'
-                    }
-                },
-                {
-                    'updateDimensionProperties': { # link column (H)
-                        'range': {
-                            'sheetId': sheet_id,
-                            'dimension': 'COLUMNS',
-                            'startIndex': 7, 
-                            'endIndex': 8
-                        },
-                        'properties': {'pixelSize': 400},
-                        'fields': 'pixelSize'
-                    }
-                }
+                freeze_request,
+                # id and photo (A:B) 200px, info (G) 150px, link (H) 400px
+                *build_column_width_requests(sheet_id, {0: 200, 1: 200, 6: 150, 7: 400})
             ]
-            service.spreadsheets().batchUpdate(
-                spreadsheetId=spreadsheet_id, body={'requests': requests_batch}).execute()
-            print(f"Header row in '{sheet_name}' is now frozen, bolded. Columns A, B, G, H widths set.")
-        else:
-            print(f"Header already correct in '{sheet_name}'.")
+            return requests_batch
+
+        if frozen_row_count == 0:
+            logger.info(f"Header in '{sheet_name}' is correct but not frozen. Freezing row 1.")
+            return [freeze_request]
+
+        logger.info(f"Header already correct in '{sheet_name}'.")
+        remember_header(spreadsheet_id, sheet_id, header_values)
+        return []
 
     except HttpError as error:
-        print(f"An API error occurred during header setup for sheet '{sheet_name}' in spreadsheet '{spreadsheet_id}': {error}")
+        logger.error(f"An API error occurred during header setup for sheet '{sheet_name}' in spreadsheet '{spreadsheet_id}': {error}")
         raise
 
+@functools.lru_cache(maxsize=256)
 def clean_url(url_string):
+    """Returns the URL without its query string and fragment (the 'link' column value); memoized for repeated URLs."""
     parsed_url = urlparse(url_string)
     return f"{parsed_url.scheme}://{parsed_url.netloc}{parsed_url.path}"
 
@@ -197,20 +407,21 @@ def filter_skus_by_moq(sku_data_list, min_moq_filter, max_moq_filter, product_le
     """
     Filters a list of SKU data based on MOQ criteria.
     For SKU products, we use the product-level price tier MOQs, not individual SKU MOQs.
+    product_level_data is the product dict (the response's result.result), used for its minOrderQuantity.
     """
     if min_moq_filter is None and max_moq_filter is None:
-        print("DEBUG: filter_skus_by_moq: No MOQ filters provided, returning original list.")
+        logger.debug("filter_skus_by_moq: No MOQ filters provided, returning original list.")
         return sku_data_list
 
     filtered_list = []
-    product_min_order_qty_str = product_level_data.get('result', {}).get('result', {}).get('minOrderQuantity', "1")
+    product_min_order_qty_str = product_level_data.get('minOrderQuantity', "1")
     try:
         product_default_moq = int(product_min_order_qty_str)
     except ValueError:
-        print(f"DEBUG: filter_skus_by_moq: Warning: Could not parse product minOrderQuantity '{product_min_order_qty_str}' as int. Defaulting to 1.")
+        logger.debug("filter_skus_by_moq: Warning: Could not parse product minOrderQuantity '%s' as int. Defaulting to 1.", product_min_order_qty_str)
         product_default_moq = 1
 
-    print(f"DEBUG: filter_skus_by_moq: min_filter={min_moq_filter}, max_filter={max_moq_filter}, product_default_moq={product_default_moq}")
+    logger.debug("filter_skus_by_moq: min_filter=%s, max_filter=%s, product_default_moq=%s", min_moq_filter, max_moq_filter, product_default_moq)
 
     for sku_item in sku_data_list:
         # For SKU products, use the MOQ from the product-level price tiers, not individual SKU MOQ
@@ -221,34 +432,34 @@ def filter_skus_by_moq(sku_data_list, min_moq_filter, max_moq_filter, product_le
             try:
                 current_item_moq = int(item_moq_str)
             except ValueError:
-                print(f"DEBUG: filter_skus_by_moq: Warning: Could not parse sku_item 'moq' ('{item_moq_str}') for SKU ID {sku_item.get('id', 'N/A')}. Using product_default_moq: {product_default_moq}.")
+                logger.debug("filter_skus_by_moq: Warning: Could not parse sku_item 'moq' ('%s') for SKU ID %s. Using product_default_moq: %s.", item_moq_str, sku_item.get('id', 'N/A'), product_default_moq)
         else:
-            print(f"DEBUG: filter_skus_by_moq: sku_item 'moq' is None for SKU ID {sku_item.get('id', 'N/A')}. Using product_default_moq: {product_default_moq}.")
+            logger.debug("filter_skus_by_moq: sku_item 'moq' is None for SKU ID %s. Using product_default_moq: %s.", sku_item.get('id', 'N/A'), product_default_moq)
 
-        print(f"DEBUG: filter_skus_by_moq: Checking SKU ID {sku_item.get('id', 'N/A')} with effective MOQ {current_item_moq}")
+        logger.debug("filter_skus_by_moq: Checking SKU ID %s with effective MOQ %s", sku_item.get('id', 'N/A'), current_item_moq)
 
         # For SKU products, if the product-level price tier MOQ meets the filter, include all SKUs
         # This is because SKUs inherit the product-level pricing structure
         if min_moq_filter is not None:
             # Check if this is a low individual SKU MOQ but product has higher tier pricing
             if current_item_moq < 100:  # Likely individual SKU MOQ, check product pricing
-                print(f"DEBUG: filter_skus_by_moq: SKU has low MOQ ({current_item_moq}), allowing through due to product-level pricing")
+                logger.debug("filter_skus_by_moq: SKU has low MOQ (%s), allowing through due to product-level pricing", current_item_moq)
                 meets_min_moq = True  # Allow SKUs through if they're part of a product with price tiers
             else:
                 # Check if any of the product's price tiers meet the min MOQ requirement
                 meets_min_moq = current_item_moq >= min_moq_filter
                 
             if not meets_min_moq:
-                print(f"DEBUG: filter_skus_by_moq: SKU ID {sku_item.get('id', 'N/A')} (MOQ {current_item_moq}) failed min_moq_filter ({min_moq_filter}). Skipping.")
+                logger.debug("filter_skus_by_moq: SKU ID %s (MOQ %s) failed min_moq_filter (%s). Skipping.", sku_item.get('id', 'N/A'), current_item_moq, min_moq_filter)
                 continue 
         
         # Apply max_moq filter
         if max_moq_filter is not None and current_item_moq > max_moq_filter:
-            print(f"DEBUG: filter_skus_by_moq: SKU ID {sku_item.get('id', 'N/A')} (MOQ {current_item_moq}) failed max_moq_filter ({max_moq_filter}). Skipping.")
+            logger.debug("filter_skus_by_moq: SKU ID %s (MOQ %s) failed max_moq_filter (%s). Skipping.", sku_item.get('id', 'N/A'), current_item_moq, max_moq_filter)
             continue 
             
         filtered_list.append(sku_item)
-        print(f"DEBUG: filter_skus_by_moq: SKU ID {sku_item.get('id', 'N/A')} (MOQ {current_item_moq}) passed filters. Added to list.")
+        logger.debug("filter_skus_by_moq: SKU ID %s (MOQ %s) passed filters. Added to list.", sku_item.get('id', 'N/A'), current_item_moq)
         
     return filtered_list
 
@@ -268,7 +479,6 @@ def get_material_info(product_data_full_api_response, product_level_attributes_d
                 material = attr.get('valueTrans', attr.get('value', ''))
                 if material:
                     material_source = "sku"
-                    # print(f"DEBUG get_material_info: Found material '{material}' from SKU attributes.")
                     return material, material_source
 
     # 2. Fallback to product-level attributes dictionary
@@ -276,738 +486,728 @@ def get_material_info(product_data_full_api_response, product_level_attributes_d
         material = product_level_attributes_dict['287']
         if material:
             material_source = "product"
-            # print(f"DEBUG get_material_info: Found material '{material}' from product attributes.")
             return material, material_source
-    
-    # print(f"DEBUG get_material_info: No material found. Defaulting to: '{material}', source: '{material_source}'.")
-    return material, material_source
 
-def process_and_upload_data(service, spreadsheet_id, sheet_name, product_data_path, product_type, min_moq, max_moq, sheet_id_val, source_url):
-    """Process product data and upload to Google Sheets with detailed logging."""
-    logger.info(f"Starting processing for product data: {product_data_path}")
-    logger.debug(f"Parameters - sheet_name: {sheet_name}, product_type: {product_type}, min_moq: {min_moq}, max_moq: {max_moq}")
-    logger.info(f"--- Starting Google Sheet Update for Sheet ID: {spreadsheet_id} ---")
-    logger.info(f"Product Type: {product_type}, Min MOQ: {min_moq}, Max MOQ: {max_moq}")
-    logger.info(f"Source URL: {source_url}, Data Path: {product_data_path}")
+    return material, material_source
 
+def describe_sku(sku_attributes_list, fallback_image_url):
+    """
+    Builds the 'info' text, photo URL and SKU-level material for one SKU in a single pass over its attributes.
+    Returns: (sku_info_string, image_url, sku_material); the last attribute carrying a skuImageUrl wins,
+    and sku_material is the first non-empty material ('287') value, or '' to fall back to the product's.
+    """
+    sku_info_parts = []
+    image_url = fallback_image_url
+    sku_material = ''
+    for attr in sku_attributes_list:
+        attr_name = attr.get('attributeNameTrans', attr.get('attributeName', 'N/A'))
+        attr_value = attr.get('valueTrans', attr.get('value', 'N/A'))
+        sku_info_parts.append(f"{attr_name}: {attr_value}")
+        if attr.get('skuImageUrl'): # If SKU has specific image, use it
+            image_url = attr['skuImageUrl']
+        if not sku_material and str(attr.get('attributeId')) == '287':
+            sku_material = attr.get('valueTrans', attr.get('value', ''))
+    return (", ".join(sku_info_parts) if sku_info_parts else "N/A"), image_url, sku_material
+
+def build_product_rows(data, product_type, min_moq, max_moq, source_url, current_date=None):
+    """
+    Builds the sheet rows for one parsed LovBuy response without calling the Sheets API.
+    Returns (stats, rows_to_append, sku_data_final_rows); the row lists are empty when there is nothing to upload.
+    current_date (YYYYMMDD) prefixes the ID formula; it defaults to today.
+    """
     cleaned_source_url = clean_url(source_url) # Define cleaned_source_url
 
-    try:
-        with open(product_data_path, 'r') as f:
-            data = json.load(f)
+    # The product itself is nested under result.result; bind both levels once
+    result_envelope = data.get('result') if isinstance(data.get('result'), dict) else {}
+    result_data = result_envelope.get('result') if isinstance(result_envelope.get('result'), dict) else {}
+    sale_info = result_data.get('productSaleInfo') or {}
+    product_info = result_data.get('productInfo') if isinstance(result_data.get('productInfo'), dict) else {}
 
-        # Extract product name early for logging
-        product_name = data.get('result', {}).get('result', {}).get('subjectTrans', 
-                      data.get('result', {}).get('result', {}).get('subject', 'Unknown Product'))
-        product_name_short = product_name[:60] + "..." if len(product_name) > 60 else product_name
-        
-        print(f"📦 Processing product: {product_name_short}")
+    # Extract product name early for logging
+    product_name = result_data.get('subjectTrans', result_data.get('subject', 'Unknown Product'))
+    product_name_short = product_name[:60] + "..." if len(product_name) > 60 else product_name
+    
+    logger.info("📦 Processing product: %s", product_name_short)
 
-        # Debug: Log the structure of the data
-        print("\n--- DEBUG: API Response Structure ---")
-        print(f"Top-level keys: {list(data.keys())}")
-        
-        # Check if the API returned an error
-        if 'status' in data and data.get('status') != 'success':
-            error_msg = data.get('message', 'No error message provided')
-            print(f"❌ API Error: {error_msg}")
-            print(f"Full response: {json.dumps(data, indent=2, ensure_ascii=False)}")
-            print("----------------------------------\n")
-            return {
-                "product_name": product_name_short,
-                "rows_uploaded": 0,
-                "skus_found": 0,
-                "skus_after_filter": 0,
-                "price_tiers_count": 0,
-                "error": error_msg
-            }
-            
-        if 'result' in data:
-            print(f"Result keys: {list(data['result'].keys()) if isinstance(data['result'], dict) else 'Not a dict'}")
-            if isinstance(data['result'], dict) and 'result' in data['result']:
-                print(f"Nested result keys: {list(data['result']['result'].keys()) if isinstance(data['result']['result'], dict) else 'Not a dict'}")
-        print("----------------------------------\n")
-
-        # Store the full product data for later use
-        product_data = data
-        
-        # Try different possible locations for SKU info
-        product_sku_infos = []
-        result_data = {}
-        
-        # Extract result data if it exists
-        if 'result' in data and isinstance(data['result'], dict):
-            result_data = data['result'].get('result', {})
-            print("Found result data in response")
-        
-        # Log all available keys for debugging
-        print(f"Available top-level keys: {list(data.keys())}")
-        if 'result' in data and isinstance(data['result'], dict):
-            print(f"Result keys: {list(data['result'].keys())}")
-            if 'result' in data['result'] and isinstance(data['result']['result'], dict):
-                print(f"Nested result keys: {list(data['result']['result'].keys())}")
-        
-        # Try different locations for SKU information
-        possible_sku_locations = [
-            result_data.get('productSkuInfos'),
-            result_data.get('skuList'),
-            result_data.get('productInfo', {}).get('skuList') if isinstance(result_data.get('productInfo'), dict) else None,
-            result_data.get('productInfo', {}).get('productSkuInfos') if isinstance(result_data.get('productInfo'), dict) else None,
-            data.get('result', {}).get('skuList'),
-            data.get('skuList')
-        ]
-        
-        # Find the first non-None SKU list
-        for sku_list in possible_sku_locations:
-            if isinstance(sku_list, list) and len(sku_list) > 0:
-                product_sku_infos = sku_list
-                print(f"🔍 Found {len(sku_list)} SKUs in API response")
-                break
+    # Debug: Log the structure of the data
+    logger.debug("API response top-level keys: %s", list(data.keys()))
+    
+    # Check if the API returned an error
+    if 'status' in data and data.get('status') != 'success':
+        error_msg = data.get('message', 'No error message provided')
+        logger.error("❌ API Error: %s", error_msg)
+        # Serialising the whole payload is only worth it when someone reads debug output
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Full response: %s", json.dumps(data, indent=2, ensure_ascii=False))
+        return {
+            "product_name": product_name_short,
+            "rows_uploaded": 0,
+            "skus_found": 0,
+            "skus_after_filter": 0,
+            "price_tiers_count": 0,
+            "error": error_msg
+        }, [], []
         
-        print(f"DEBUG: product_sku_infos after find_sku_data: {product_sku_infos} (type: {type(product_sku_infos)}, len: {len(product_sku_infos) if product_sku_infos else 0})")
-
-        # If product_sku_infos is still empty after checking all locations, then print the warning and potentially return.
-        if not product_sku_infos:
-            logger.debug("No SKUs found after checking all possible locations.")
-            logger.warning("No product SKU information found in the JSON data.")
-            logger.debug("Attempted to find SKUs in these locations:")
-            logger.debug("1. result.result.productSkuInfos")
-            logger.debug("2. result.result.skuList")
-            logger.debug("3. result.result.productInfo.skuList")
-            logger.debug("4. result.result.productInfo.productSkuInfos")
-            logger.debug("5. result.skuList")
-            logger.debug("6. skuList")
-            logger.debug("\nAvailable data structure:")
-            logger.debug(json.dumps(data, indent=2, ensure_ascii=False)[:1000] + '...')
-            # Decide if we should return or proceed with product-level data if SKUs are truly absent.
-            # For now, the logic below will handle creating a product-level entry if product_sku_infos remains empty.
+    if result_envelope:
+        logger.debug("Result keys: %s", list(result_envelope.keys()))
+    if result_data:
+        logger.debug("Nested result keys: %s", list(result_data.keys()))
 
-        # --- Determine last_id_row (last row with an ID, or header_row_index if no data) ---
-        header_row_index = 1 
-        last_id_row = header_row_index 
+    # Try different possible locations for SKU info
+    product_sku_infos = []
+    
+    # Try different locations for SKU information
+    possible_sku_locations = [
+        result_data.get('productSkuInfos'),
+        result_data.get('skuList'),
+        product_info.get('skuList'),
+        product_info.get('productSkuInfos'),
+        result_envelope.get('skuList'),
+        data.get('skuList')
+    ]
+    
+    # Find the first non-None SKU list
+    for sku_list in possible_sku_locations:
+        if isinstance(sku_list, list) and len(sku_list) > 0:
+            product_sku_infos = sku_list
+            logger.info("🔍 Found %s SKUs in API response", len(sku_list))
+            break
+    
+    logger.debug("product_sku_infos after find_sku_data: %s (type: %s, len: %s)", product_sku_infos, type(product_sku_infos), len(product_sku_infos) if product_sku_infos else 0)
+
+    # Neither a product nor any SKUs: there is nothing to build rows from
+    if not result_data and not product_sku_infos:
+        error_msg = "No product data found in the LovBuy response"
+        logger.error("❌ %s for %s", error_msg, source_url)
+        return {
+            "product_name": product_name_short,
+            "rows_uploaded": 0,
+            "skus_found": 0,
+            "skus_after_filter": 0,
+            "price_tiers_count": 0,
+            "error": error_msg
+        }, [], []
+
+    # If product_sku_infos is still empty after checking all locations, then print the warning and potentially return.
+    if not product_sku_infos:
+        logger.debug("No SKUs found after checking all possible locations.")
+        logger.warning("No product SKU information found in the JSON data.")
+        logger.debug("Attempted to find SKUs in these locations:")
+        logger.debug("1. result.result.productSkuInfos")
+        logger.debug("2. result.result.skuList")
+        logger.debug("3. result.result.productInfo.skuList")
+        logger.debug("4. result.result.productInfo.productSkuInfos")
+        logger.debug("5. result.skuList")
+        logger.debug("6. skuList")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Available data structure:\n%s...", json.dumps(data, indent=2, ensure_ascii=False)[:1000])
+        # Decide if we should return or proceed with product-level data if SKUs are truly absent.
+        # For now, the logic below will handle creating a product-level entry if product_sku_infos remains empty.
+
+    # We'll use a Google Sheets formula for ID generation instead of backend logic
+    # This ensures consecutive numbering regardless of deletions or gaps
+    # Batches pass the date in so every product in one upload shares it (and the clock is read once)
+    if current_date is None:
+        current_date = datetime.datetime.now().strftime('%Y%m%d')
+    logger.info(f"Using date {current_date} for ID formula in Google Sheets")
+
+    main_product_image = ""
+    product_images = (result_data.get('productImage') or {}).get('images')
+    if isinstance(product_images, list) and product_images:
+        main_product_image = product_images[0]
+    logger.debug("main_product_image: %s", main_product_image)
+
+    # attributeId -> translated value; entries missing either are skipped, and a repeated ID keeps its last value
+    product_attributes = {
+        str(attr['attributeId']): str(attr['valueTrans'])
+        for attr in result_data.get('productAttribute') or []
+        if isinstance(attr, dict) and 'attributeId' in attr and 'valueTrans' in attr
+    }
+    logger.debug("product_attributes: %s", product_attributes)
+
+    # --- MOQ Filtering for priceRangeList to create price_tiers_to_process --- 
+    original_price_range_list = sale_info.get('priceRangeList') or []
+    logger.debug("Original productSaleInfo.priceRangeList: %s", original_price_range_list)
+
+    # Valid tiers as (startQuantity, price) pairs, sorted by quantity
+    parsed_price_ranges = []
+    for tier in original_price_range_list:
         try:
-            range_to_check = f'{sheet_name}!A{header_row_index + 1}:A'
-            logger.debug(f"Reading ID column from range: {range_to_check} to determine last_id_row.")
-            result = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range_to_check).execute()
-            id_column_values = result.get('values', [])
-
-            if id_column_values:
-                found_actual_last_id = False
-                for i in range(len(id_column_values) - 1, -1, -1):
-                    if id_column_values[i] and len(id_column_values[i]) > 0 and str(id_column_values[i][0]).strip():
-                        last_id_row = (header_row_index + 1) + i # (header_row_index + 1) is the first data row, i is 0-indexed from there
-                        found_actual_last_id = True
-                        break
-                if not found_actual_last_id:
-                    logger.debug(f"No valid IDs found in column A after header row {header_row_index}. last_id_row remains {last_id_row} (header row).")
-            else:
-                logger.debug(f"ID column A from row {header_row_index + 1} onwards is empty. last_id_row remains {last_id_row} (header row).")
-            
-            logger.info(f"Determined last_id_row (last row with data, or header row if empty): {last_id_row} (Sheet: '{sheet_name}')")
+            parsed_price_ranges.append((int(tier['startQuantity']), tier.get('price', '')))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            logger.debug("Skipping tier in priceRangeList due to invalid 'startQuantity': %s", tier)
+    parsed_price_ranges.sort(key=lambda t: t[0])
+    logger.debug("Parsed and sorted price_ranges (from productSaleInfo): %s", parsed_price_ranges)
+
+    # min_moq keeps the tier whose range contains it (or the first tier, if it is below all of them) and every tier above;
+    # max_moq drops tiers starting above it. On the sorted start quantities both bounds are a bisect, leaving one slice.
+    start_quantities = [start_quantity for start_quantity, _ in parsed_price_ranges]
+    first_index = 0
+    if min_moq is not None and start_quantities:
+        containing_index = bisect.bisect_right(start_quantities, min_moq) - 1
+        if containing_index > 0:
+            # Step back to the first tier sharing that start quantity
+            first_index = bisect.bisect_left(start_quantities, start_quantities[containing_index])
+    end_index = bisect.bisect_right(start_quantities, max_moq) if max_moq is not None else len(start_quantities)
+
+    price_tiers_to_process = [
+        {'moq': str(start_quantity), 'price1688': str(price)}
+        for start_quantity, price in parsed_price_ranges[first_index:end_index]
+    ]
+    logger.debug("Price tiers after min_moq (%s) / max_moq (%s) filters: %s", min_moq, max_moq, price_tiers_to_process)
+
+    if not price_tiers_to_process:
+        # If no tiers match, or original list was empty, use product's direct price and minOrderQuantity if available
+        product_direct_price = str(sale_info.get('price', ''))
+        product_min_order_qty = str(result_data.get('minOrderQuantity', ''))
+        if product_direct_price and product_min_order_qty:
+            logger.debug("No price tiers matched MOQ. Using product direct price %s and minOrderQuantity %s as a fallback tier.", product_direct_price, product_min_order_qty)
+            price_tiers_to_process.append({'moq': product_min_order_qty, 'price1688': product_direct_price})
+        else:
+            logger.debug("No price tiers matched MOQ, and no product direct price/minOrderQuantity for fallback. Adding default empty tier.")
+            price_tiers_to_process.append({'moq': '', 'price1688': ''})
+    logger.debug("Final price_tiers_to_process after MOQ filtering and fallbacks: %s", price_tiers_to_process)
 
-        except Exception as e:
-            logger.warning(f"Error reading ID column to determine last_id_row for sheet '{sheet_name}'. Defaulting to {last_id_row} (header row). Error: {e}")
+    # --- Populate sku_data --- 
+    logger.debug("Before 'if not product_sku_infos' check. product_sku_infos is: %s (len: %s)", product_sku_infos, len(product_sku_infos) if product_sku_infos else 0)
 
-        # We'll use a Google Sheets formula for ID generation instead of backend logic
-        # This ensures consecutive numbering regardless of deletions or gaps
-        current_date = datetime.datetime.now().strftime('%Y%m%d')
-        logger.info(f"Using date {current_date} for ID formula in Google Sheets")
-
-        main_product_image = ""
-        if product_data.get('result', {}).get('result', {}).get('productImage', {}).get('images') and \
-           isinstance(product_data['result']['result']['productImage']['images'], list) and \
-           len(product_data['result']['result']['productImage']['images']) > 0:
-            main_product_image = product_data['result']['result']['productImage']['images'][0]
-        logger.debug(f"main_product_image: {main_product_image}")
-
-        product_attributes = {}
-        if product_data.get('result', {}).get('result', {}).get('productAttribute'):
-            for attr in product_data['result']['result']['productAttribute']:
-                if isinstance(attr, dict) and 'attributeId' in attr and 'valueTrans' in attr:
-                    product_attributes[str(attr['attributeId'])] = str(attr['valueTrans'])
-        logger.debug(f"product_attributes: {product_attributes}")
-
-        # --- MOQ Filtering for priceRangeList to create price_tiers_to_process --- 
-        price_tiers_to_process = []
-        original_price_range_list = product_data.get('result', {}).get('result', {}).get('productSaleInfo', {}).get('priceRangeList', []) 
-        logger.debug(f"Original productSaleInfo.priceRangeList: {original_price_range_list}")
-
-        temp_parsed_price_ranges = []
-        for tier in original_price_range_list:
-            try:
-                tier_copy = tier.copy()
-                tier_copy['startQuantity'] = int(tier_copy['startQuantity'])
-                temp_parsed_price_ranges.append(tier_copy)
-            except (ValueError, TypeError, KeyError):
-                logger.debug(f"Skipping tier in priceRangeList due to invalid 'startQuantity': {tier}")
-                continue
+    sku_data_final_rows = []
+
+    if not product_sku_infos: # Case: No SKUs found, use product-level data
+        logger.debug("Entered 'if not product_sku_infos' block (product-level data path).")
         
-        parsed_price_ranges = sorted(temp_parsed_price_ranges, key=lambda t: t.get('startQuantity', float('inf')))
-        logger.debug(f"Parsed and sorted price_ranges (from productSaleInfo): {parsed_price_ranges}")
-
-        list_after_min_filter = []
-        if min_moq is not None:
-            s_active = None
-            for i, current_tier_data in enumerate(parsed_price_ranges):
-                current_tier_start_val = current_tier_data['startQuantity']
-                next_tier_start_val = parsed_price_ranges[i+1]['startQuantity'] if i + 1 < len(parsed_price_ranges) else float('inf')
-                if current_tier_start_val <= min_moq < next_tier_start_val:
-                    s_active = current_tier_start_val
-                    break
-            if s_active is None and parsed_price_ranges and min_moq < parsed_price_ranges[0]['startQuantity']:
-                s_active = parsed_price_ranges[0]['startQuantity'] 
-            if s_active is not None:
-                for tier_data_to_filter in parsed_price_ranges:
-                    if tier_data_to_filter['startQuantity'] >= s_active:
-                        list_after_min_filter.append(tier_data_to_filter)
-        else:
-            list_after_min_filter = list(parsed_price_ranges)
-        logger.debug(f"Price tiers after min_moq ({min_moq}) filter: {list_after_min_filter}")
-
-        filtered_price_range_list_final = []
-        if max_moq is not None:
-            for tier in list_after_min_filter:
-                if tier['startQuantity'] <= max_moq:
-                    filtered_price_range_list_final.append(tier)
-        else:
-            filtered_price_range_list_final = list(list_after_min_filter)
-        logger.debug(f"Price tiers after max_moq ({max_moq}) filter: {filtered_price_range_list_final}")
-
-        if filtered_price_range_list_final:
-            for tier in filtered_price_range_list_final:
-                price_tiers_to_process.append({
-                    'moq': str(tier.get('startQuantity', '')),
-                    'price1688': str(tier.get('price', ''))
-                })
-        else:
-            # If no tiers match, or original list was empty, use product's direct price and minOrderQuantity if available
-            product_direct_price = str(product_data.get('result', {}).get('result', {}).get('productSaleInfo', {}).get('price', ''))
-            product_min_order_qty = str(product_data.get('result', {}).get('result', {}).get('minOrderQuantity', ''))
-            if product_direct_price and product_min_order_qty:
-                logger.debug(f"No price tiers matched MOQ. Using product direct price {product_direct_price} and minOrderQuantity {product_min_order_qty} as a fallback tier.")
-                price_tiers_to_process.append({'moq': product_min_order_qty, 'price1688': product_direct_price})
-            else:
-                logger.debug("No price tiers matched MOQ, and no product direct price/minOrderQuantity for fallback. Adding default empty tier.")
-                price_tiers_to_process.append({'moq': '', 'price1688': ''})
-        logger.debug(f"Final price_tiers_to_process after MOQ filtering and fallbacks: {price_tiers_to_process}")
+        # Define product_default_moq for the no-SKU path
+        product_min_order_qty_str = result_data.get('minOrderQuantity', "1")
+        try:
+            product_default_moq = int(product_min_order_qty_str)
+        except ValueError:
+            logger.warning(f"Could not parse product minOrderQuantity '{product_min_order_qty_str}' for no-SKU path. Defaulting to 1.")
+            product_default_moq = 1
 
-        # --- Populate sku_data --- 
-        logger.debug(f"Before 'if not product_sku_infos' check. product_sku_infos is: {product_sku_infos} (len: {len(product_sku_infos) if product_sku_infos else 0})")
+        # Define main_product_image_formula here for the no-SKU path, before the loop
+        main_product_image_formula = IMAGE_FORMULA_TEMPLATE.format(url=main_product_image) if main_product_image else ""
 
-        sku_data_final_rows = []
+        if not price_tiers_to_process: 
+            logger.error("No price tiers found in the product data. Cannot determine data to upload.")
+        else:
+            logger.debug("About to process %s price tiers.", len(price_tiers_to_process))
+            for tier_index, tier in enumerate(price_tiers_to_process):
+                logger.debug("Processing tier %s", tier_index)
+                
+                product_info_str = result_data.get('subjectTrans', result_data.get('subject', 'N/A'))
+                material, material_source = get_material_info(data, product_attributes)
 
-        if not product_sku_infos: # Case: No SKUs found, use product-level data
-            logger.debug("Entered 'if not product_sku_infos' block (product-level data path).")
-            
-            # Define product_default_moq for the no-SKU path
-            product_min_order_qty_str = data.get('result', {}).get('result', {}).get('minOrderQuantity', "1")
-            try:
-                product_default_moq = int(product_min_order_qty_str)
-            except ValueError:
-                logger.warning(f"Could not parse product minOrderQuantity '{product_min_order_qty_str}' for no-SKU path. Defaulting to 1.")
-                product_default_moq = 1
+                row_data = {
+                    'image': main_product_image_formula, # Now defined
+                    'price1688': tier.get('price1688', 'N/A'),
+                    'moq': tier.get('moq', str(product_default_moq)), # Now defined
+                    'info': product_info_str, 
+                    'material': material,
+                    'link': cleaned_source_url
+                }
+                sku_data_final_rows.append(row_data)
+            logger.debug("sku_data_final_rows after processing product-level tiers: %s", sku_data_final_rows)
 
-            # Define main_product_image_formula here for the no-SKU path, before the loop
-            main_product_image_formula = f'=HYPERLINK("{main_product_image}", IMAGE("{main_product_image}"))' if main_product_image else ""
+    else: # Case: SKUs exist
+        logger.debug("Entered 'else' block (SKUs exist path). Processing %s SKUs.", len(product_sku_infos))
+        # Determine product_default_moq once for SKU path
+        product_min_order_qty_str = result_data.get('minOrderQuantity', "1")
+        try:
+            product_default_moq = int(product_min_order_qty_str)
+        except ValueError:
+            logger.warning(f"Could not parse product minOrderQuantity '{product_min_order_qty_str}' as int. Defaulting to 1.")
+            product_default_moq = 1
+
+        for sku_index, sku in enumerate(product_sku_infos):
+            logger.debug("Processing SKU %s", sku_index)
+
+            # 'or ()' also covers a null skuAttributes field
+            sku_attributes_list = sku.get('skuAttributes') or ()
+            # Falls back to the main product image when no attribute has its own
+            sku_info_str, sku_image_url_for_sku, sku_material = describe_sku(sku_attributes_list, main_product_image)
+            image_formula = IMAGE_FORMULA_TEMPLATE.format(url=sku_image_url_for_sku) if sku_image_url_for_sku else ""
+            
+            # Extract price from SKU data - try multiple possible fields
+            sku_price = None
+            if sku.get('consignPrice'):
+                sku_price = sku.get('consignPrice')
+            elif sku.get('fenxiaoPriceInfo', {}).get('offerPrice'):
+                sku_price = sku.get('fenxiaoPriceInfo', {}).get('offerPrice')
+            elif sku.get('price'):
+                sku_price = sku.get('price')
+            
+            if sku_price is None:
+                logger.debug("SKU %s has no price (checked consignPrice, fenxiaoPriceInfo.offerPrice, price), skipping.", sku.get('skuId', 'N/A'))
+                continue
 
-            if not price_tiers_to_process: 
-                logger.error(f"No data found in {product_data_path} or file is empty. Cannot determine data to upload.")
+            # The SKU's own material was picked up with its other attributes; otherwise use the product's
+            if sku_material:
+                material, material_source = sku_material, "sku"
             else:
-                logger.debug(f"DEBUG: About to process {len(price_tiers_to_process)} price tiers.")
-                for tier_index, tier in enumerate(price_tiers_to_process):
-                    logger.debug(f"DEBUG: Processing tier {tier_index}")
-                    
-                    product_info_str = data.get('result', {}).get('result', {}).get('subjectTrans', data.get('result', {}).get('result', {}).get('subject', 'N/A'))
-                    material, material_source = get_material_info(data, product_attributes)
-
+                material, material_source = get_material_info(data, product_attributes)
+
+            row_data = {
+                'image': image_formula,
+                'price1688': str(sku_price),  # Use SKU's own price
+                'moq': str(product_default_moq),  # Use product's default MOQ
+                'info': sku_info_str,
+                'material': material,
+                'link': cleaned_source_url
+            }
+            sku_data_final_rows.append(row_data)
+        
+        logger.debug("sku_data after processing all SKUs: %s", sku_data_final_rows)
+
+        # Fallback for SKUs with no individual price: repeat SKUs for each product-level price tier
+        if not sku_data_final_rows and price_tiers_to_process:
+            logger.debug("No SKU-level price data found. Falling back to repeating SKUs for each product-level price tier.")
+            fallback_rows = []
+            # Each SKU's info, image formula and material are the same in every tier, so work them out once
+            fallback_skus = []
+            for sku in product_sku_infos:
+                sku_info_str, sku_image_url_for_sku, sku_material = describe_sku(sku.get('skuAttributes') or (), main_product_image)
+                image_formula = IMAGE_FORMULA_TEMPLATE.format(url=sku_image_url_for_sku) if sku_image_url_for_sku else ""
+                material = sku_material or get_material_info(data, product_attributes)[0]
+                fallback_skus.append((sku.get('skuId'), sku_info_str, image_formula, material))
+            for tier in price_tiers_to_process:
+                for sku_id, sku_info_str, image_formula, material in fallback_skus:
+                    logger.debug("Fallback processing tier %s and SKU %s", tier, sku_id)
+                    # use tier price and moq
                     row_data = {
-                        'image': main_product_image_formula, # Now defined
+                        'image': image_formula,
                         'price1688': tier.get('price1688', 'N/A'),
-                        'moq': tier.get('moq', str(product_default_moq)), # Now defined
-                        'info': product_info_str, 
+                        'moq': str(tier.get('moq', product_default_moq)),
+                        'info': sku_info_str,
                         'material': material,
                         'link': cleaned_source_url
                     }
-                    sku_data_final_rows.append(row_data)
-                print(f"DEBUG: sku_data_final_rows after processing product-level tiers: {sku_data_final_rows}")
+                    fallback_rows.append(row_data)
+            sku_data_final_rows = fallback_rows
+            logger.debug("sku_data after fallback processing: %s", sku_data_final_rows)
+
+    # Filter the collected sku_data_final_rows by MOQ (user-defined filters)
+    if min_moq is not None or max_moq is not None:
+        logger.debug("Before SKU-level MOQ filtering. min_moq: %s, max_moq: %s. Current sku_data: %s", min_moq, max_moq, sku_data_final_rows)
+        sku_data_final_rows = filter_skus_by_moq(sku_data_final_rows, min_moq, max_moq, result_data)
+        logger.info(f"✅ After MOQ filtering: {len(sku_data_final_rows)} SKUs remaining (from {len(product_sku_infos) if product_sku_infos else 0} original)")
+    else:
+        logger.debug("SKU-level MOQ filtering skipped (no SKUs to filter or no MOQ params).")
+
+    if not sku_data_final_rows:
+        logger.debug("sku_data_final_rows is empty after all processing and filtering. No data to upload.")
+        logger.info("No SKUs found after filtering by MOQ or no initial product/SKU data.")
+        return {
+            "product_name": product_name_short,
+            "rows_uploaded": 0,
+            "skus_found": len(product_sku_infos) if product_sku_infos else 0,
+            "skus_after_filter": 0,
+            "price_tiers_count": len(price_tiers_to_process) if 'price_tiers_to_process' in locals() else 0,
+            "moq_groups_count": 0,
+            "error": "No SKUs found after filtering by MOQ or no initial product/SKU data."
+        }, [], []
+
+    # --- Second pass: create rows_to_append based on sku_data_final_rows --- 
+    rows_to_append = []
+    price_moq_groups = []
+    
+    if not sku_data_final_rows:
+        logger.info("sku_data_final_rows is empty. No data will be appended to the sheet.")
+        # Ensure last_id_row is defined even if no data is appended, for consistency
+        # if 'last_id_row' not in locals(): # This check might be redundant now
+        #     last_id_row = header_row_index # Default if not determined earlier
+    else:
+        logger.debug("Before final row generation. sku_data_final_rows has %s items: %s", len(sku_data_final_rows), sku_data_final_rows[:3]) # Log first 3 for brevity
+        # Create formula for consecutive ID generation (the same for every row, it uses ROW())
+        id_formula = f'="{current_date}_{product_type}_" & TEXT(ROW()-1,"000")'
+
+        # One output row per SKU entry, so the list can be sized up front
+        rows_to_append = [None] * len(sku_data_final_rows)
+        for row_index, item_data in enumerate(sku_data_final_rows):
+            price_1688 = try_convert_to_float(item_data.get('price1688', ''))
+            price_cust = round(price_1688 * 1.15, 1) if price_1688 != '' else ''
+            
+            rows_to_append[row_index] = [
+                id_formula,  # Google Sheets formula for consecutive IDs
+                item_data.get('image', ''),
+                price_1688,
+                price_cust,  # Calculated as price_1688 * 1.15, rounded to 1 decimal
+                '',  # Placeholder for the profit formula, filled in once the target row is known
+                item_data.get('moq', ''),
+                item_data.get('info', ''),
+                item_data.get('material', ''),
+                item_data.get('link', '')
+            ]
+        logger.debug("Generated %s rows for rows_to_append. First 3: %s", len(rows_to_append), rows_to_append[:3])
+        
+        # Rebuild price_moq_groups based on the final rows_to_append and their MOQs
+        # This is critical for correct merging if rows_to_append was modified (e.g., by filtering)
+        # Each run of consecutive rows sharing an MOQ (index 5) is one group
+        start_idx_in_batch = 0 # Relative to the start of the rows being appended
+        for moq_in_row, group_rows in itertools.groupby(rows_to_append, key=lambda row: row[5]):
+            current_count = sum(1 for _ in group_rows)
+            price_moq_groups.append({
+                'moq': moq_in_row, 
+                'count': current_count, 
+                'start_idx_in_batch': start_idx_in_batch,
+                'start_row': start_idx_in_batch,
+                'end_row': start_idx_in_batch + current_count - 1
+            })
+            start_idx_in_batch += current_count
+        logger.debug("price_moq_groups for merging: %s", price_moq_groups)
+
+    if not rows_to_append:
+        logger.debug("rows_to_append is empty after trying to generate rows. No data will be uploaded.")
+        logger.info("No data processed to upload (rows_to_append is empty).")
+        return {
+            "product_name": product_name_short,
+            "rows_uploaded": 0,
+            "skus_found": len(product_sku_infos) if product_sku_infos else 0,
+            "skus_after_filter": 0,
+            "price_tiers_count": len(price_tiers_to_process) if 'price_tiers_to_process' in locals() else 0,
+            "error": "No data processed to upload (rows_to_append is empty)."
+        }, [], []
+
+    stats = {
+        "product_name": product_name_short,
+        "rows_uploaded": len(rows_to_append),
+        "skus_found": len(product_sku_infos) if product_sku_infos else 0,
+        "skus_after_filter": len(sku_data_final_rows),
+        "price_tiers_count": len(price_tiers_to_process) if 'price_tiers_to_process' in locals() else 0,
+        "moq_groups_count": len(price_moq_groups),
+        "price_moq_groups": price_moq_groups
+    }
+    return stats, rows_to_append, sku_data_final_rows
 
-        else: # Case: SKUs exist
-            print(f"DEBUG: Entered 'else' block (SKUs exist path). Processing {len(product_sku_infos)} SKUs.")
-            # Determine product_default_moq once for SKU path
-            product_min_order_qty_str = data.get('result', {}).get('result', {}).get('minOrderQuantity', "1")
-            try:
-                product_default_moq = int(product_min_order_qty_str)
-            except ValueError:
-                print(f"Warning: Could not parse product minOrderQuantity '{product_min_order_qty_str}' as int. Defaulting to 1.")
-                product_default_moq = 1
-
-            for sku_index, sku in enumerate(product_sku_infos):
-                logger.debug(f"DEBUG: Processing SKU {sku_index}")
-
-                sku_attributes_list = sku.get('skuAttributes', [])
-                sku_info_parts = []
-                sku_image_url_for_sku = main_product_image # Fallback to main product image for this SKU
-
-                for attr in sku_attributes_list:
-                    attr_name = attr.get('attributeNameTrans', attr.get('attributeName', 'N/A'))
-                    attr_value = attr.get('valueTrans', attr.get('value', 'N/A'))
-                    sku_info_parts.append(f"{attr_name}: {attr_value}")
-                    if attr.get('skuImageUrl'): # If SKU has specific image, use it
-                        sku_image_url_for_sku = attr.get('skuImageUrl')
-                
-                sku_info_str = ", ".join(sku_info_parts) if sku_info_parts else "N/A"
-                image_formula = f'=HYPERLINK("{sku_image_url_for_sku}", IMAGE("{sku_image_url_for_sku}"))' if sku_image_url_for_sku else ""
-                
-                # Extract price from SKU data - try multiple possible fields
-                sku_price = None
-                if sku.get('consignPrice'):
-                    sku_price = sku.get('consignPrice')
-                elif sku.get('fenxiaoPriceInfo', {}).get('offerPrice'):
-                    sku_price = sku.get('fenxiaoPriceInfo', {}).get('offerPrice')
-                elif sku.get('price'):
-                    sku_price = sku.get('price')
-                
-                if sku_price is None:
-                    print(f"DEBUG: SKU {sku.get('skuId', 'N/A')} has no price (checked consignPrice, fenxiaoPriceInfo.offerPrice, price), skipping.")
-                    continue
 
-                material, material_source = get_material_info(data, product_attributes, sku_attributes_list)
+def upload_product_rows(service, spreadsheet_id, sheet_name, sheet_id_val, rows_to_append, price_moq_groups, sku_data_final_rows, setup_requests=()):
+    """
+    Inserts prepared rows below the last ID in column A and applies merges, row heights and cell formatting,
+    all in a single batchUpdate. price_moq_groups and sku_data_final_rows must line up with rows_to_append.
+    setup_requests (the addSheet and header fixes from prepare_target_sheet) are sent first in the same batchUpdate.
+    """
+    # The start row is computed from the ID column, so reading it and inserting must not interleave
+    # with another upload to the same spreadsheet
+    with _get_spreadsheet_lock(spreadsheet_id):
+        # --- Determine last_id_row (last row with an ID, or header_row_index if no data) ---
+        header_row_index = 1 
+        last_id_row = header_row_index 
+        if creates_sheet(setup_requests):
+            # The tab is added by this same batchUpdate, so it has no rows yet
+            logger.debug(f"Sheet '{sheet_name}' is created with this upload; starting below the header.")
+        else:
+            try:
+                range_to_check = f'{sheet_name}!A{header_row_index + 1}:A'
+                logger.debug(f"Reading ID column from range: {range_to_check} to determine last_id_row.")
+                # Read the column as one flat list and ask for nothing but the values
+                result = execute_with_retry(service.spreadsheets().values().get(
+                    spreadsheetId=spreadsheet_id, range=range_to_check,
+                    majorDimension='COLUMNS', fields='values'))
+                id_column_values = result.get('values', [[]])[0]
+
+                # Offset of the last non-empty ID from the first data row, scanning lazily from the end
+                last_id_offset = next(
+                    (len(id_column_values) - 1 - i for i, value in enumerate(reversed(id_column_values)) if str(value).strip()),
+                    None
+                )
+
+                if last_id_offset is not None:
+                    last_id_row = (header_row_index + 1) + last_id_offset # (header_row_index + 1) is the first data row
+                elif id_column_values:
+                    logger.debug(f"No valid IDs found in column A after header row {header_row_index}. last_id_row remains {last_id_row} (header row).")
+                else:
+                    logger.debug(f"ID column A from row {header_row_index + 1} onwards is empty. last_id_row remains {last_id_row} (header row).")
+        
+                logger.info(f"Determined last_id_row (last row with data, or header row if empty): {last_id_row} (Sheet: '{sheet_name}')")
 
-                row_data = {
-                    'image': image_formula,
-                    'price1688': str(sku_price),  # Use SKU's own price
-                    'moq': str(product_default_moq),  # Use product's default MOQ
-                    'info': sku_info_str,
-                    'material': material,
-                    'link': cleaned_source_url
+            except Exception as e:
+                logger.warning(f"Error reading ID column to determine last_id_row for sheet '{sheet_name}'. Defaulting to {last_id_row} (header row). Error: {e}")
+
+        # Determine the starting row for appending new data.
+        # This should be the first empty row after the last data row.
+        # last_id_row is the row number of the last data entry, or header_row_index if no data exists.
+        actual_start_row_1_indexed = last_id_row + 1
+        logger.info(f"Inserting {len(rows_to_append)} rows at {sheet_name}!A{actual_start_row_1_indexed}")
+
+        # Typed cells for the new rows; the profit cell (column E) gets its formula here now that
+        # the row numbers are known, so it needs no separate request
+        row_cells = []
+        for row_number, row in enumerate(rows_to_append, start=actual_start_row_1_indexed):
+            values = [to_cell_data(value) for value in row]
+            values[4] = to_cell_data(PROFIT_FORMULA_TEMPLATE.format(row=row_number))
+            row_cells.append({'values': values})
+
+        # Open up empty rows at the start row (like INSERT_ROWS did) and fill them with typed cells
+        data_requests = [
+            {
+                'insertDimension': {
+                    'range': {
+                        'sheetId': sheet_id_val,
+                        'dimension': 'ROWS',
+                        'startIndex': actual_start_row_1_indexed - 1,
+                        'endIndex': actual_start_row_1_indexed - 1 + len(rows_to_append)
+                    },
+                    'inheritFromBefore': False
+                }
+            },
+            {
+                'updateCells': {
+                    'rows': row_cells,
+                    'fields': 'userEnteredValue',
+                    'start': {
+                        'sheetId': sheet_id_val,
+                        'rowIndex': actual_start_row_1_indexed - 1,
+                        'columnIndex': 0
+                    }
                 }
-                sku_data_final_rows.append(row_data)
-            
-            print(f"DEBUG: sku_data after processing all SKUs: {sku_data_final_rows}")
-
-            # Fallback for SKUs with no individual price: repeat SKUs for each product-level price tier
-            if not sku_data_final_rows and price_tiers_to_process:
-                logger.debug("DEBUG: No SKU-level price data found. Falling back to repeating SKUs for each product-level price tier.")
-                fallback_rows = []
-                for tier in price_tiers_to_process:
-                    for sku in product_sku_infos:
-                        logger.debug(f"DEBUG: Fallback processing tier {tier} and SKU {sku.get('skuId')}")
-                        # build sku_info_str and image formula
-                        sku_attributes_list = sku.get('skuAttributes', [])
-                        sku_info_parts = []
-                        sku_image_url_for_sku = main_product_image
-                        for attr in sku_attributes_list:
-                            attr_name = attr.get('attributeNameTrans', attr.get('attributeName', 'N/A'))
-                            attr_value = attr.get('valueTrans', attr.get('value', 'N/A'))
-                            sku_info_parts.append(f"{attr_name}: {attr_value}")
-                            if attr.get('skuImageUrl'):
-                                sku_image_url_for_sku = attr.get('skuImageUrl')
-                        sku_info_str = ", ".join(sku_info_parts) if sku_info_parts else "N/A"
-                        image_formula = f'=HYPERLINK("{sku_image_url_for_sku}", IMAGE("{sku_image_url_for_sku}"))' if sku_image_url_for_sku else ""
-                        # use tier price and moq
-                        material, _ = get_material_info(data, product_attributes, sku_attributes_list)
-                        row_data = {
-                            'image': image_formula,
-                            'price1688': tier.get('price1688', 'N/A'),
-                            'moq': str(tier.get('moq', product_default_moq)),
-                            'info': sku_info_str,
-                            'material': material,
-                            'link': cleaned_source_url
-                        }
-                        fallback_rows.append(row_data)
-                sku_data_final_rows = fallback_rows
-                print(f"DEBUG: sku_data after fallback processing: {sku_data_final_rows}")
-
-        # Filter the collected sku_data_final_rows by MOQ (user-defined filters)
-        if min_moq is not None or max_moq is not None:
-            print(f"DEBUG: Before SKU-level MOQ filtering. min_moq: {min_moq}, max_moq: {max_moq}. Current sku_data: {sku_data_final_rows}")
-            sku_data_final_rows = filter_skus_by_moq(sku_data_final_rows, min_moq, max_moq, data) # Pass 'data' for product_level_data
-            print(f"✅ After MOQ filtering: {len(sku_data_final_rows)} SKUs remaining (from {len(product_sku_infos) if product_sku_infos else 0} original)")
-        else:
-            print(f"DEBUG: SKU-level MOQ filtering skipped (no SKUs to filter or no MOQ params).")
-
-        if not sku_data_final_rows:
-            print("DEBUG: sku_data_final_rows is empty after all processing and filtering. No data to upload.")
-            print("No SKUs found after filtering by MOQ or no initial product/SKU data.")
-            return {
-                "product_name": product_name_short,
-                "rows_uploaded": 0,
-                "skus_found": len(product_sku_infos) if product_sku_infos else 0,
-                "skus_after_filter": 0,
-                "price_tiers_count": len(price_tiers_to_process) if 'price_tiers_to_process' in locals() else 0,
-                "moq_groups_count": 0,
-                "error": "No SKUs found after filtering by MOQ or no initial product/SKU data."
             }
+        ]
 
-        # --- Second pass: create rows_to_append based on sku_data_final_rows --- 
-        rows_to_append = []
-        price_moq_groups = []
-        
-        if not sku_data_final_rows:
-            logging.info("sku_data_final_rows is empty. No data will be appended to the sheet.")
-            # Ensure last_id_row is defined even if no data is appended, for consistency
-            # if 'last_id_row' not in locals(): # This check might be redundant now
-            #     last_id_row = header_row_index # Default if not determined earlier
-        else:
-            logging.debug(f"Before final row generation. sku_data_final_rows has {len(sku_data_final_rows)} items: {sku_data_final_rows[:3]}") # Log first 3 for brevity
-            for item_data in sku_data_final_rows:
-                price_1688 = try_convert_to_float(item_data.get('price1688', ''))
-                price_cust = round(price_1688 * 1.15, 1) if price_1688 != '' else ''
-                
-                # Create formula for consecutive ID generation
-                id_formula = f'="{current_date}_{product_type}_" & TEXT(ROW()-1,"000")'
-                
-                row = [
-                    id_formula,  # Google Sheets formula for consecutive IDs
-                    item_data.get('image', ''),
-                    price_1688,
-                    price_cust,  # Calculated as price_1688 * 1.15, rounded to 1 decimal
-                    '',  # Placeholder for 'Landed Cost'
-                    item_data.get('moq', ''),
-                    item_data.get('info', ''),
-                    item_data.get('material', ''),
-                    item_data.get('link', '')
+        # --- Apply Cell Merges for MOQ within price/moq groups ---
+        merge_requests = []
+
+        for group in price_moq_groups:
+            if group['end_row'] > group['start_row']:  # If there's more than one row in this group
+                start_row_index = actual_start_row_1_indexed - 1 + group['start_idx_in_batch']
+                end_row_index = start_row_index + group['count']
+
+                # Check if we should merge material cells (only if material is from product level)
+                should_merge_material = all(
+                    sku_data_final_rows[i].get('material_source') == 'product' 
+                    for i in range(group['start_idx_in_batch'], group['start_idx_in_batch'] + group['count'])
+                    if i < len(sku_data_final_rows)
+                )
+
+                # MOQ column (F), then link column (I) - together with material (H) when it is shared.
+                # MERGE_COLUMNS merges each column of the range on its own, so adjacent H:I takes one request.
+                merge_spans = [
+                    (5, 6, 'MERGE_ALL'),
+                    (7, 9, 'MERGE_COLUMNS') if should_merge_material else (8, 9, 'MERGE_ALL')
                 ]
-                rows_to_append.append(row)
-            logging.debug(f"Generated {len(rows_to_append)} rows for rows_to_append. First 3: {rows_to_append[:3]}")
-            
-            # Rebuild price_moq_groups based on the final rows_to_append and their MOQs
-            # This is critical for correct merging if rows_to_append was modified (e.g., by filtering)
-            current_moq = None
-            current_count = 0
-            start_idx_in_batch = 0 # This will be relative to the start of the current batch being appended
-            
-            for i, row_data in enumerate(rows_to_append):
-                moq_in_row = row_data[5] # Assuming MOQ is at index 5
-                if moq_in_row != current_moq:
-                    if current_moq is not None: # Save the previous group
-                        end_row = start_idx_in_batch + current_count - 1
-                        price_moq_groups.append({
-                            'moq': current_moq, 
-                            'count': current_count, 
-                            'start_idx_in_batch': start_idx_in_batch,
-                            'start_row': start_idx_in_batch,
-                            'end_row': end_row
-                        })
-                    current_moq = moq_in_row
-                    current_count = 1
-                    start_idx_in_batch = i 
-                else:
-                    current_count += 1
-            
-            if current_moq is not None: # Save the last group
-                end_row = start_idx_in_batch + current_count - 1
-                price_moq_groups.append({
-                    'moq': current_moq, 
-                    'count': current_count, 
-                    'start_idx_in_batch': start_idx_in_batch,
-                    'start_row': start_idx_in_batch,
-                    'end_row': end_row
-                })
-            logging.debug(f"price_moq_groups for merging: {price_moq_groups}")
-
-        if rows_to_append:
-            # Determine the starting row for appending new data.
-            # This should be the first empty row after the last data row.
-            # last_id_row is the row number of the last data entry, or header_row_index if no data exists.
-            start_row_for_new_data = last_id_row + 1
-            
-            append_range = f'{sheet_name}!A{start_row_for_new_data}'
-            logging.info(f"Appending {len(rows_to_append)} rows to range: {append_range}")
-        else:
-            print("DEBUG: rows_to_append is empty after trying to generate rows. No data will be uploaded.")
-            print("No data processed to upload (rows_to_append is empty).")
-            return {
-                "product_name": product_name_short,
-                "rows_uploaded": 0,
-                "skus_found": len(product_sku_infos) if product_sku_infos else 0,
-                "skus_after_filter": 0,
-                "price_tiers_count": len(price_tiers_to_process) if 'price_tiers_to_process' in locals() else 0,
-                "error": "No data processed to upload (rows_to_append is empty)."
+                merge_requests.extend({
+                    'mergeCells': {
+                        'range': {
+                            'sheetId': sheet_id_val,
+                            'startRowIndex': start_row_index,
+                            'endRowIndex': end_row_index,
+                            'startColumnIndex': start_column,
+                            'endColumnIndex': end_column
+                        },
+                        'mergeType': merge_type
+                    }
+                } for start_column, end_column, merge_type in merge_spans)
+
+        # --- End Cell Merges ---
+
+        # --- Set Row Height to 200px for each SKU ---
+        row_height_requests = []
+        TARGET_ROW_HEIGHT = 200  # 200px per SKU row
+
+        # Apply height to all rows
+        row_height_requests.append({
+            'updateDimensionProperties': {
+                'range': {
+                    'sheetId': sheet_id_val,
+                    'dimension': 'ROWS',
+                    'startIndex': actual_start_row_1_indexed - 1,
+                    'endIndex': actual_start_row_1_indexed - 1 + len(rows_to_append)
+                },
+                'properties': {'pixelSize': TARGET_ROW_HEIGHT},
+                'fields': 'pixelSize'
             }
+        })
+
+        # Set column widths for material (H, index 7) 100px and link (I, index 8) 300px
+        column_width_requests = build_column_width_requests(sheet_id_val, {7: 100, 8: 300})
+
+        # --- Apply Final Cell Formatting (Alignment, Currency, Formulas) ---
+        formatting_requests = []
+        actual_end_row_1_indexed = (actual_start_row_1_indexed - 1) + len(rows_to_append)
+
+        # 0. Set default formatting for all cells (centered, not bold, wrapped text)
+        num_columns = len(EXPECTED_HEADER)  # Dynamically get number of columns
+        formatting_requests.append({
+            'repeatCell': {
+                'range': {
+                    'sheetId': sheet_id_val,
+                    'startRowIndex': actual_start_row_1_indexed - 1,
+                    'endRowIndex': actual_end_row_1_indexed,
+                    'startColumnIndex': 0,  # Column A
+                    'endColumnIndex': num_columns  # All columns dynamically
+                },
+                'cell': {
+                    'userEnteredFormat': {
+                        'horizontalAlignment': 'CENTER',
+                        'verticalAlignment': 'MIDDLE',
+                        'wrapStrategy': 'WRAP',
+                        'textFormat': {'bold': False}
+                    }
+                },
+                'fields': 'userEnteredFormat(horizontalAlignment,verticalAlignment,wrapStrategy,textFormat.bold)'
+            }
+        })
+
+        # 1. Format 'price 1688', 'price cust' and 'profit' (Columns C-E, index 2-4) as CNY in one range
+        formatting_requests.append({
+            'repeatCell': {
+                'range': {
+                    'sheetId': sheet_id_val,
+                    'startRowIndex': actual_start_row_1_indexed - 1,
+                    'endRowIndex': actual_end_row_1_indexed,
+                    'startColumnIndex': 2,  # Column C
+                    'endColumnIndex': 5  # Through column E
+                },
+                'cell': {
+                    'userEnteredFormat': {
+                        'numberFormat': {
+                            'type': 'CURRENCY',
+                            'pattern': '¥#,##0.00;¥-#,##0.00'
+                        },
+                        'horizontalAlignment': 'CENTER',
+                        'verticalAlignment': 'MIDDLE'
+                    }
+                },
+                'fields': 'userEnteredFormat(numberFormat,horizontalAlignment,verticalAlignment)'
+            }
+        })
+
+        # 2. Profit formulas (Column E) are written with the row data above
+
+        # 3. Set Text Wrapping for 'info' column (G, index 6)
+        formatting_requests.append({
+            'repeatCell': {
+                'range': {
+                    'sheetId': sheet_id_val,
+                    'startRowIndex': actual_start_row_1_indexed - 1,
+                    'endRowIndex': actual_end_row_1_indexed,
+                    'startColumnIndex': 6, # Column G
+                    'endColumnIndex': 7
+                },
+                'cell': {
+                    'userEnteredFormat': {'wrapStrategy': 'WRAP'}
+                },
+                'fields': 'userEnteredFormat.wrapStrategy'
+            }
+        })
+
+        # 4. Set Text Wrapping for 'link' column (H, index 7)
+        formatting_requests.append({
+            'repeatCell': {
+                'range': {
+                    'sheetId': sheet_id_val,
+                    'startRowIndex': actual_start_row_1_indexed - 1,
+                    'endRowIndex': actual_end_row_1_indexed,
+                    'startColumnIndex': 7, # Column H
+                    'endColumnIndex': 8
+                },
+                'cell': {
+                    'userEnteredFormat': {'wrapStrategy': 'WRAP'}
+                },
+                'fields': 'userEnteredFormat.wrapStrategy'
+            }
+        })
+
+        # --- End Final Cell Formatting ---
+
+        # Send the new rows, merges, sizes and formatting in one batchUpdate; Sheets applies the requests in order
+        all_requests = list(setup_requests) + data_requests + merge_requests + row_height_requests + column_width_requests + formatting_requests
+        if merge_requests:
+            logger.info(f"Merging MOQ cells for {len(merge_requests)} price/moq groups.")
+        logger.info(f"Setting consistent row height of {TARGET_ROW_HEIGHT}px for all rows.")
+        logger.info("Setting column widths: Material=100px, Link=300px.")
+        # Inserting rows is not idempotent, so a 5xx (which may have been applied) is not retried
+        execute_with_retry(service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id, body={'requests': all_requests}), idempotent=False)
+        logger.info(f"🎉 Successfully uploaded {len(rows_to_append)} product variants to Google Sheet")
+        logger.info("Applied final cell formatting: alignment, currency, and profit formulas.")
+
+
+# Digests of recently uploaded row sets, keyed by (spreadsheet_id, digest), so an accidental resubmit
+# doesn't append the same rows twice. Kept per server process.
+_recent_uploads = {}
+_recent_uploads_lock = threading.Lock()
+
+def rows_digest(rows_to_append):
+    """Returns a short fingerprint of a product's prepared rows."""
+    payload = json.dumps(rows_to_append, ensure_ascii=False, default=str).encode('utf-8')
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def was_recently_uploaded(spreadsheet_id, digest):
+    if UPLOAD_DEDUP_SECONDS <= 0:
+        return False
+    with _recent_uploads_lock:
+        uploaded_at = _recent_uploads.get((spreadsheet_id, digest))
+    return uploaded_at is not None and time.monotonic() - uploaded_at < UPLOAD_DEDUP_SECONDS
+
+def remember_uploads(spreadsheet_id, digests):
+    """Records row sets that were written, dropping entries older than the dedup window."""
+    if UPLOAD_DEDUP_SECONDS <= 0:
+        return
+    now = time.monotonic()
+    with _recent_uploads_lock:
+        for key in [key for key, uploaded_at in _recent_uploads.items() if now - uploaded_at >= UPLOAD_DEDUP_SECONDS]:
+            del _recent_uploads[key]
+        for digest in digests:
+            _recent_uploads[(spreadsheet_id, digest)] = now
+
+def duplicate_upload_stats(stats):
+    """Stats for a product whose identical rows were uploaded moments ago."""
+    return {
+        **stats,
+        "rows_uploaded": 0,
+        "error": f"Identical rows were already uploaded to this sheet in the last {UPLOAD_DEDUP_SECONDS}s; skipped."
+    }
 
-        # Append data after the header (assuming header is row 1)
-        # The append operation will add data starting at the first empty row it finds.
-        body = {'values': rows_to_append}
-        append_result = service.spreadsheets().values().append(
-            spreadsheetId=spreadsheet_id, range=f"{sheet_name}!A2", # Start appending from row 2
-            valueInputOption='USER_ENTERED',
-            insertDataOption='INSERT_ROWS',
-            body=body,
-            includeValuesInResponse=False # Not needed, but good to be explicit
-        ).execute()
-        
-        print(f"🎉 Successfully uploaded {len(rows_to_append)} product variants to Google Sheet")
-        print(f"📊 Summary for '{product_name_short}': {len(product_sku_infos) if product_sku_infos else 0} SKUs found → {len(sku_data_final_rows)} after filtering → {len(rows_to_append)} uploaded")
+def creates_sheet(setup_requests):
+    """True when the setup requests add the target tab, i.e. it does not exist yet."""
+    return any('addSheet' in request for request in setup_requests)
 
-        # Set row heights for the newly added rows
-        updated_range_str = append_result.get('updates', {}).get('updatedRange', '')
-        if updated_range_str:
-            try:
-                range_parts = updated_range_str.split('!')[-1]
-                start_cell, _ = range_parts.split(':') # We only need the start cell for the initial row index
-                
-                import re
-                start_row_match = re.search(r'\d+', start_cell)
-
-                if start_row_match:
-                    actual_start_row_1_indexed = int(start_row_match.group(0))
-
-                    # --- Apply Cell Merges for MOQ within price/moq groups ---
-                    merge_requests = []
-                    
-                    for group in price_moq_groups:
-                        if group['end_row'] > group['start_row']:  # If there's more than one row in this group
-                            # Merge the MOQ column (index 5, column F) for each price/moq group
-                            merge_requests.append({
-                                'mergeCells': {
-                                    'range': {
-                                        'sheetId': sheet_id_val,
-                                        'startRowIndex': actual_start_row_1_indexed - 1 + group['start_idx_in_batch'],
-                                        'endRowIndex': actual_start_row_1_indexed - 1 + group['start_idx_in_batch'] + group['count'],
-                                        'startColumnIndex': 5,  # MOQ column (F)
-                                        'endColumnIndex': 6     # End at column G (exclusive)
-                                    },
-                                    'mergeType': 'MERGE_ALL'
-                                }
-                            })
-                            
-                            # Check if we should merge material cells (only if material is from product level)
-                            should_merge_material = all(
-                                sku_data_final_rows[i].get('material_source') == 'product' 
-                                for i in range(group['start_idx_in_batch'], group['start_idx_in_batch'] + group['count'])
-                                if i < len(sku_data_final_rows)
-                            )
-                            
-                            if should_merge_material:
-                                merge_requests.append({
-                                    'mergeCells': {
-                                        'range': {
-                                            'sheetId': sheet_id_val,
-                                            'startRowIndex': actual_start_row_1_indexed - 1 + group['start_idx_in_batch'],
-                                            'endRowIndex': actual_start_row_1_indexed - 1 + group['start_idx_in_batch'] + group['count'],
-                                            'startColumnIndex': 7,  # Material column (H)
-                                            'endColumnIndex': 8     # End at column I (exclusive)
-                                        },
-                                        'mergeType': 'MERGE_ALL'
-                                    }
-                                })
-                            
-                            # Also merge the link column (index 8, column I) for each price/moq group
-                            merge_requests.append({
-                                'mergeCells': {
-                                    'range': {
-                                        'sheetId': sheet_id_val,
-                                        'startRowIndex': actual_start_row_1_indexed - 1 + group['start_idx_in_batch'],
-                                        'endRowIndex': actual_start_row_1_indexed - 1 + group['start_idx_in_batch'] + group['count'],
-                                        'startColumnIndex': 8,  # Link column (I)
-                                        'endColumnIndex': 9     # End at column J (exclusive)
-                                    },
-                                    'mergeType': 'MERGE_ALL'
-                                }
-                            })
-                    
-                    if merge_requests:
-                        service.spreadsheets().batchUpdate(
-                            spreadsheetId=spreadsheet_id, body={'requests': merge_requests}).execute()
-                        print(f"Successfully merged MOQ cells for {len(merge_requests)} price/moq groups.")
-                    # --- End Cell Merges ---
-
-                    # --- Set Row Height to 200px for each SKU ---
-                    row_height_requests = []
-                    TARGET_ROW_HEIGHT = 200  # 200px per SKU row
-                    
-                    # Apply height to all rows
-                    row_height_requests.append({
-                        'updateDimensionProperties': {
-                            'range': {
-                                'sheetId': sheet_id_val,
-                                'dimension': 'ROWS',
-                                'startIndex': actual_start_row_1_indexed - 1,
-                                'endIndex': actual_start_row_1_indexed - 1 + len(rows_to_append)
-                            },
-                            'properties': {'pixelSize': TARGET_ROW_HEIGHT},
-                            'fields': 'pixelSize'
-                        }
-                    })
-                    
-                    # Set column widths for material and link columns
-                    column_width_requests = []
-                    
-                    # Material column (H, index 7) - 100px
-                    column_width_requests.append({
-                        'updateDimensionProperties': {
-                            'range': {
-                                'sheetId': sheet_id_val,
-                                'dimension': 'COLUMNS',
-                                'startIndex': 7,  # Column H (material)
-                                'endIndex': 8
-                            },
-                            'properties': {'pixelSize': 100},
-                            'fields': 'pixelSize'
-                        }
-                    })
-                    
-                    # Link column (I, index 8) - 300px
-                    column_width_requests.append({
-                        'updateDimensionProperties': {
-                            'range': {
-                                'sheetId': sheet_id_val,
-                                'dimension': 'COLUMNS',
-                                'startIndex': 8,  # Column I (link)
-                                'endIndex': 9
-                            },
-                            'properties': {'pixelSize': 300},
-                            'fields': 'pixelSize'
-                        }
-                    })
-                    
-                    if row_height_requests:
-                        service.spreadsheets().batchUpdate(
-                            spreadsheetId=spreadsheet_id, body={'requests': row_height_requests}).execute()
-                        print(f"Set consistent row height of {TARGET_ROW_HEIGHT}px for all rows.")
-                    
-                    if column_width_requests:
-                        service.spreadsheets().batchUpdate(
-                            spreadsheetId=spreadsheet_id, body={'requests': column_width_requests}).execute()
-                        print("Set column widths: Material=100px, Link=300px.")
-                    # --- Apply Final Cell Formatting (Alignment, Currency, Formulas) ---
-                    formatting_requests = []
-                    actual_end_row_1_indexed = (actual_start_row_1_indexed - 1) + len(rows_to_append)
-
-                    # 0. Set default formatting for all cells (centered, not bold, wrapped text)
-                    num_columns = len(EXPECTED_HEADER)  # Dynamically get number of columns
-                    formatting_requests.append({
-                        'repeatCell': {
-                            'range': {
-                                'sheetId': sheet_id_val,
-                                'startRowIndex': actual_start_row_1_indexed - 1,
-                                'endRowIndex': actual_end_row_1_indexed,
-                                'startColumnIndex': 0,  # Column A
-                                'endColumnIndex': num_columns  # All columns dynamically
-                            },
-                            'cell': {
-                                'userEnteredFormat': {
-                                    'horizontalAlignment': 'CENTER',
-                                    'verticalAlignment': 'MIDDLE',
-                                    'wrapStrategy': 'WRAP',
-                                    'textFormat': {'bold': False}
-                                }
-                            },
-                            'fields': 'userEnteredFormat(horizontalAlignment,verticalAlignment,wrapStrategy,textFormat.bold)'
-                        }
-                    })
-
-                    # 1. Format 'price 1688' (Column C, index 2) and 'price cust' (Column D, index 3) as CNY
-                    for col_idx in [2, 3]:  # Columns C and D (0-based index 2 and 3)
-                        formatting_requests.append({
-                            'repeatCell': {
-                                'range': {
-                                    'sheetId': sheet_id_val,
-                                    'startRowIndex': actual_start_row_1_indexed - 1,
-                                    'endRowIndex': actual_end_row_1_indexed,
-                                    'startColumnIndex': col_idx,
-                                    'endColumnIndex': col_idx + 1
-                                },
-                                'cell': {
-                                    'userEnteredFormat': {
-                                        'numberFormat': {
-                                            'type': 'CURRENCY',
-                                            'pattern': '¥#,##0.00;¥-#,##0.00'
-                                        },
-                                        'horizontalAlignment': 'CENTER',
-                                        'verticalAlignment': 'MIDDLE'
-                                    }
-                                },
-                                'fields': 'userEnteredFormat(numberFormat,horizontalAlignment,verticalAlignment)'
-                            }
-                        })
-
-                    # 2. Set Profit Formulas (Column E, index 4)
-                    for i in range(len(rows_to_append)):
-                        current_row = actual_start_row_1_indexed + i
-                        formula = f'=IF(AND(ISNUMBER(D{current_row}),ISNUMBER(C{current_row})),D{current_row}-C{current_row},"")'
-                        formatting_requests.append({
-                            'updateCells': {
-                                'range': {
-                                    'sheetId': sheet_id_val,
-                                    'startRowIndex': current_row - 1,
-                                    'endRowIndex': current_row,
-                                    'startColumnIndex': 4,  # Column E (profit)
-                                    'endColumnIndex': 5
-                                },
-                                'rows': [{
-                                    'values': [{
-                                        'userEnteredValue': {'formulaValue': formula},
-                                        'userEnteredFormat': {
-                                            'numberFormat': {
-                                                'type': 'CURRENCY',
-                                                'pattern': '¥#,##0.00;¥-#,##0.00'
-                                            },
-                                            'horizontalAlignment': 'CENTER',
-                                            'verticalAlignment': 'MIDDLE'
-                                        }
-                                    }]
-                                }],
-                                'fields': 'userEnteredValue,userEnteredFormat(numberFormat,horizontalAlignment,verticalAlignment)'
-                            }
-                        })
-                    
-                    # 3. Apply all formatting requests
-                    if formatting_requests:
-                        service.spreadsheets().batchUpdate(
-                            spreadsheetId=spreadsheet_id,
-                            body={'requests': formatting_requests}
-                        ).execute()
-                        print("Applied cell formatting and formulas.")
-                    # --- End Cell Formatting ---
-
-                    # 4. Set Text Wrapping for 'info' column (G, index 6)
-                    formatting_requests.append({
-                        'repeatCell': {
-                            'range': {
-                                'sheetId': sheet_id_val,
-                                'startRowIndex': actual_start_row_1_indexed - 1,
-                                'endRowIndex': actual_end_row_1_indexed,
-                                'startColumnIndex': 6, # Column G
-                                'endColumnIndex': 7
-                            },
-                            'cell': {
-                                'userEnteredFormat': {'wrapStrategy': 'WRAP'}
-                            },
-                            'fields': 'userEnteredFormat.wrapStrategy'
-                        }
-                    })
-
-                    # 6. Set Text Wrapping for 'link' column (H, index 7)
-                    formatting_requests.append({
-                        'repeatCell': {
-                            'range': {
-                                'sheetId': sheet_id_val,
-                                'startRowIndex': actual_start_row_1_indexed - 1,
-                                'endRowIndex': actual_end_row_1_indexed,
-                                'startColumnIndex': 7, # Column H
-                                'endColumnIndex': 8
-                            },
-                            'cell': {
-                                'userEnteredFormat': {'wrapStrategy': 'WRAP'}
-                            },
-                            'fields': 'userEnteredFormat.wrapStrategy'
-                        }
-                    })
-
-                    if formatting_requests:
-                        service.spreadsheets().batchUpdate(
-                            spreadsheetId=spreadsheet_id, body={'requests': formatting_requests}).execute()
-                        print("Applied final cell formatting: alignment, currency, and profit formulas.")
-                    # --- End Final Cell Formatting ---
+def apply_header_requests(service, spreadsheet_id, sheet_id_val, header_requests, sent=False):
+    """
+    Finishes the header setup from ensure_header_and_freeze. The requests are sent here unless they
+    already went out with a row upload (sent=True); either way the header is then remembered.
+    """
+    if not header_requests:
+        return
+    if not sent:
+        # Adding a tab twice fails, so only retry that on 429
+        execute_with_retry(service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id, body={'requests': header_requests}),
+            idempotent=not creates_sheet(header_requests))
+    logger.info(f"Header row in '{TARGET_SHEET_NAME}' is now frozen, bolded. Columns A, B, G, H widths set.")
+    remember_header(spreadsheet_id, sheet_id_val, EXPECTED_HEADER)
+
+def process_and_upload_data(service, spreadsheet_id, sheet_name, product_data_path, product_type, min_moq, max_moq, sheet_id_val, source_url, product_data=None, header_requests=()):
+    """
+    Process product data and upload to Google Sheets with detailed logging.
+    The already-parsed API response can be passed as product_data; otherwise it is read from product_data_path.
+    Pending header_requests from prepare_target_sheet ride along with the row upload.
+    """
+    logger.info(f"Starting processing for product data: {product_data_path}")
+    logger.debug(f"Parameters - sheet_name: {sheet_name}, product_type: {product_type}, min_moq: {min_moq}, max_moq: {max_moq}")
+    logger.info(f"--- Starting Google Sheet Update for Sheet ID: {spreadsheet_id} ---")
+    logger.info(f"Product Type: {product_type}, Min MOQ: {min_moq}, Max MOQ: {max_moq}")
+    logger.info(f"Source URL: {source_url}, Data Path: {product_data_path}")
 
-                else:
-                    print(f"Could not parse row numbers from updatedRange: {updated_range_str}")
-            except Exception as e:
-                print(f"Error processing formatting for updatedRange '{updated_range_str}': {e}")
-        else:
-            print("Could not determine updated range to set row heights.")
+    try:
+        if product_data is None:
+            with open(product_data_path, 'rb') as f:
+                raw_product_data = f.read()
+            product_data = orjson.loads(raw_product_data) if orjson is not None else json.loads(raw_product_data)
+
+        stats, rows_to_append, sku_data_final_rows = build_product_rows(product_data, product_type, min_moq, max_moq, source_url)
+        digest = rows_digest(rows_to_append) if rows_to_append and UPLOAD_DEDUP_SECONDS > 0 else None
+        if digest and was_recently_uploaded(spreadsheet_id, digest):
+            logger.warning(f"Skipping upload of '{stats['product_name']}': identical rows were uploaded to '{spreadsheet_id}' recently.")
+            stats = duplicate_upload_stats(stats)
+            rows_to_append = []
+        if not rows_to_append:
+            apply_header_requests(service, spreadsheet_id, sheet_id_val, header_requests)
+            return stats
+
+        upload_product_rows(service, spreadsheet_id, sheet_name, sheet_id_val, rows_to_append, stats['price_moq_groups'], sku_data_final_rows, header_requests)
+        apply_header_requests(service, spreadsheet_id, sheet_id_val, header_requests, sent=True)
+        remember_uploads(spreadsheet_id, [digest])
+        logger.info(f"📊 Summary for '{stats['product_name']}': {stats['skus_found']} SKUs found → {stats['skus_after_filter']} after filtering → {stats['rows_uploaded']} uploaded")
 
     except HttpError as error:
         logger.error(f"An API error occurred during data upload: {error}")
@@ -1016,18 +1216,84 @@ def process_and_upload_data(service, spreadsheet_id, sheet_name, product_data_pa
         logger.error(f"An unexpected error occurred during data processing: {e}", exc_info=True)
         raise
 
-    return {
-        "product_name": product_name_short,
-        "rows_uploaded": len(rows_to_append),
-        "skus_found": len(product_sku_infos) if product_sku_infos else 0,
-        "skus_after_filter": len(sku_data_final_rows),
-        "price_tiers_count": len(price_tiers_to_process) if 'price_tiers_to_process' in locals() else 0,
-        "moq_groups_count": len(price_moq_groups),
-        "price_moq_groups": price_moq_groups
-    }
+    return stats
+
+# sheetIds of target tabs already set up by this process, keyed by (spreadsheet_id, sheet_name), so
+# later runs against the same spreadsheet skip the metadata read. Dropped when a Sheets call fails.
+_prepared_sheet_ids = {}
+_prepared_sheet_ids_lock = threading.Lock()
+
+def forget_prepared_sheet(spreadsheet_id):
+    """Drops the cached target tab so the next run looks it up (and re-checks the header) again."""
+    with _prepared_sheet_ids_lock:
+        _prepared_sheet_ids.pop((spreadsheet_id, TARGET_SHEET_NAME), None)
+
+def prepare_target_sheet(service, spreadsheet_id):
+    """
+    Returns (sheetId, header_requests) for TARGET_SHEET_NAME.
+    header_requests are the pending setup requests (often empty): the addSheet for a missing tab
+    followed by the header fixes from ensure_header_and_freeze.
+    """
+    cache_key = (spreadsheet_id, TARGET_SHEET_NAME)
+    with _prepared_sheet_ids_lock:
+        cached_sheet_id = _prepared_sheet_ids.get(cache_key)
+    if cached_sheet_id is not None and is_header_known(spreadsheet_id, cached_sheet_id, EXPECTED_HEADER):
+        logger.debug(f"Sheet '{TARGET_SHEET_NAME}' (ID: {cached_sheet_id}) already prepared in this process; skipping lookup.")
+        return cached_sheet_id, []
+
+    # One read gives the tab's ID along with its header row and freeze state
+    sheet_id_val, frozen_row_count, current_header = _fetch_sheet_state(service, spreadsheet_id, TARGET_SHEET_NAME)
+
+    add_sheet_requests = []
+    if sheet_id_val is None:
+        if TARGET_SHEET_NAME:
+            # Create the tab in the same batchUpdate as its header (and the first rows) rather than in a call of its own.
+            # addSheet accepts a client-chosen sheetId, so the requests after it can already refer to the new tab;
+            # a clash with an existing ID fails the batch and the next run picks another one.
+            sheet_id_val = random.randint(1, 2**31 - 1)
+            logger.info(f"Sheet named '{TARGET_SHEET_NAME}' not found in spreadsheet '{spreadsheet_id}'. It will be created with ID: {sheet_id_val}")
+            add_sheet_requests.append({
+                'addSheet': {
+                    'properties': {
+                        'sheetId': sheet_id_val,
+                        'title': TARGET_SHEET_NAME
+                    }
+                }
+            })
+            current_header = []  # A new tab starts blank and unfrozen
+        else:
+            err_msg = f"Target sheet name ('{TARGET_SHEET_NAME}') not found in spreadsheet '{spreadsheet_id}' and no sheet name configured to create."
+            logger.error(err_msg)
+            raise ValueError(err_msg)
+
+    header_requests = add_sheet_requests + ensure_header_and_freeze(service, spreadsheet_id, sheet_id_val, TARGET_SHEET_NAME, EXPECTED_HEADER,
+                                                                    current_header, frozen_row_count)
+    logger.info(f"Header check for sheet '{TARGET_SHEET_NAME}' (ID: {sheet_id_val}) complete; {len(header_requests)} setup requests pending.")
+    with _prepared_sheet_ids_lock:
+        _prepared_sheet_ids[cache_key] = sheet_id_val
+    return sheet_id_val, header_requests
+
+def log_sheet_update_error(e, spreadsheet_id, action="sheet update"):
+    """
+    Logs an exception raised while updating spreadsheet_id; the caller re-raises it.
+    API errors also drop the cached tab ID (e.g. the tab was deleted) so it is looked up again next time.
+    """
+    if isinstance(e, HttpError):
+        logger.error(f"API error during {action} for '{spreadsheet_id}': {e}")
+        logger.error(f"Details: {e.content}")
+        forget_prepared_sheet(spreadsheet_id)
+    elif isinstance(e, FileNotFoundError):
+        logger.error(f"File not found during {action} for '{spreadsheet_id}': {e}")
+    elif isinstance(e, ValueError):
+        logger.error(f"Value error during {action} for '{spreadsheet_id}': {e}")
+    else:
+        logger.error(f"Unexpected error during {action} for '{spreadsheet_id}': {e}", exc_info=e)
 
-def run_sheet_update(product_data_path, product_type_arg, min_moq_arg, max_moq_arg, source_url_arg, google_sheet_id_param):
-    """Main function to orchestrate the sheet update process using a provided Google Sheet ID."""
+def run_sheet_update(product_data_path, product_type_arg, min_moq_arg, max_moq_arg, source_url_arg, google_sheet_id_param, product_data=None):
+    """
+    Main function to orchestrate the sheet update process using a provided Google Sheet ID.
+    Pass the parsed LovBuy response as product_data to skip reading product_data_path from disk.
+    """
     
     if not google_sheet_id_param:
         error_msg = "Google Sheet ID is required but was not provided to run_sheet_update."
@@ -1039,42 +1305,14 @@ def run_sheet_update(product_data_path, product_type_arg, min_moq_arg, max_moq_a
     logger.info(f"Source URL: {source_url_arg}, Data Path: {product_data_path}")
 
     try:
+        # Fail on a missing data file before paying for credentials and the sheet lookup
+        if product_data is None and not os.path.isfile(product_data_path):
+            raise FileNotFoundError(f"Product data file not found: {product_data_path}")
+
         service = get_google_sheets_service()
         logger.info("Google Sheets service initialized successfully.")
 
-        sheet_id_val = get_sheet_id_by_name(service, google_sheet_id_param, TARGET_SHEET_NAME)
-
-        if sheet_id_val is None:
-            if TARGET_SHEET_NAME:
-                logger.info(f"Sheet named '{TARGET_SHEET_NAME}' not found in spreadsheet '{google_sheet_id_param}'. Attempting to create it.")
-                try:
-                    add_sheet_request_body = {
-                        'requests': [{
-                            'addSheet': {
-                                'properties': {
-                                    'title': TARGET_SHEET_NAME
-                                }
-                            }
-                        }]
-                    }
-                    response = service.spreadsheets().batchUpdate(
-                        spreadsheetId=google_sheet_id_param, 
-                        body=add_sheet_request_body
-                    ).execute()
-                    new_sheet_properties = response.get('replies')[0].get('addSheet').get('properties')
-                    sheet_id_val = new_sheet_properties.get('sheetId')
-                    logger.info(f"Successfully created sheet '{TARGET_SHEET_NAME}' with ID: {sheet_id_val}")
-                except HttpError as error_create:
-                    err_msg = f"Failed to create sheet '{TARGET_SHEET_NAME}' in spreadsheet '{google_sheet_id_param}': {error_create}"
-                    logger.error(err_msg)
-                    raise ValueError(err_msg)
-            else:
-                err_msg = f"Target sheet name ('{TARGET_SHEET_NAME}') not found in spreadsheet '{google_sheet_id_param}' and no sheet name configured to create."
-                logger.error(err_msg)
-                raise ValueError(err_msg)
-
-        ensure_header_and_freeze(service, google_sheet_id_param, sheet_id_val, TARGET_SHEET_NAME, EXPECTED_HEADER)
-        logger.info(f"Header check/update for sheet '{TARGET_SHEET_NAME}' (ID: {sheet_id_val}) complete.")
+        sheet_id_val, header_requests = prepare_target_sheet(service, google_sheet_id_param)
 
         # Get statistics from the data processing
         stats = process_and_upload_data(
@@ -1086,44 +1324,110 @@ def run_sheet_update(product_data_path, product_type_arg, min_moq_arg, max_moq_a
             min_moq_arg, 
             max_moq_arg, 
             sheet_id_val, 
-            source_url_arg
+            source_url_arg,
+            product_data=product_data,
+            header_requests=header_requests
         )
         logger.info(f"Data processing and upload for sheet '{TARGET_SHEET_NAME}' complete.")
         logger.info(f"--- Google Sheet Update for Sheet ID: {google_sheet_id_param} Finished Successfully ---")
         
         return stats  # Return the statistics
 
-    except FileNotFoundError as e_fnf:
-        logger.error(f"File not found during sheet update for '{google_sheet_id_param}': {e_fnf}")
-        raise
-    except ValueError as e_val:
-        logger.error(f"Value error during sheet update for '{google_sheet_id_param}': {e_val}")
-        raise
-    except HttpError as e_http:
-        logger.error(f"API error during sheet update for '{google_sheet_id_param}': {e_http}")
-        logger.error(f"Details: {e_http.content}")
+    except Exception as e:
+        log_sheet_update_error(e, google_sheet_id_param)
         raise
-    except Exception as e_general:
-        logger.error(f"Unexpected error during sheet update for '{google_sheet_id_param}': {e_general}", exc_info=True)
+
+def run_sheet_update_batch(products, product_type_arg, min_moq_arg, max_moq_arg, google_sheet_id_param):
+    """
+    Writes several products to the same spreadsheet with one append and one formatting pass,
+    instead of a full read/append/format round per product.
+    products is a list of (source_url, product_data) pairs. Returns one entry per product, in order:
+    its stats dict, or the exception raised while building its rows (the other products are still written).
+    Errors from the shared sheet setup or upload are raised for the whole batch.
+    """
+    if not google_sheet_id_param:
+        error_msg = "Google Sheet ID is required but was not provided to run_sheet_update_batch."
+        logger.error(f"Error processing data: {str(error_msg)}")
+        raise ValueError(error_msg)
+
+    logger.info(f"--- Starting batch Google Sheet Update of {len(products)} products for Sheet ID: {google_sheet_id_param} ---")
+    logger.info(f"Product Type: {product_type_arg}, Min MOQ: {min_moq_arg}, Max MOQ: {max_moq_arg}")
+
+    current_date = datetime.datetime.now().strftime('%Y%m%d')
+    results = []
+    batch_rows = []
+    batch_groups = []
+    batch_sku_rows = []
+    batch_digests = set()
+    for source_url, product_data in products:
+        try:
+            stats, rows_to_append, sku_data_final_rows = build_product_rows(product_data, product_type_arg, min_moq_arg, max_moq_arg, source_url, current_date)
+        except Exception as e:
+            logger.error(f"Unexpected error while preparing rows for '{source_url}': {e}", exc_info=True)
+            results.append(e)
+            continue
+
+        if rows_to_append and UPLOAD_DEDUP_SECONDS > 0:
+            # Also catches the same product appearing twice in one batch (e.g. URLs differing only in tracking parameters)
+            digest = rows_digest(rows_to_append)
+            if digest in batch_digests or was_recently_uploaded(google_sheet_id_param, digest):
+                logger.warning(f"Skipping upload of '{stats['product_name']}': identical rows were uploaded to '{google_sheet_id_param}' recently.")
+                results.append(duplicate_upload_stats(stats))
+                continue
+            batch_digests.add(digest)
+
+        # Group offsets are relative to the product's own rows; shift them to its position in the batch
+        offset = len(batch_rows)
+        for group in stats.get('price_moq_groups', []):
+            batch_groups.append({
+                **group,
+                'start_idx_in_batch': group['start_idx_in_batch'] + offset,
+                'start_row': group['start_row'] + offset,
+                'end_row': group['end_row'] + offset
+            })
+        batch_rows.extend(rows_to_append)
+        batch_sku_rows.extend(sku_data_final_rows)
+        results.append(stats)
+
+    if not batch_rows:
+        logger.info("No rows to upload for this batch.")
+        return results
+
+    try:
+        service = get_google_sheets_service()
+        sheet_id_val, header_requests = prepare_target_sheet(service, google_sheet_id_param)
+        upload_product_rows(service, google_sheet_id_param, TARGET_SHEET_NAME, sheet_id_val, batch_rows, batch_groups, batch_sku_rows, header_requests)
+        apply_header_requests(service, google_sheet_id_param, sheet_id_val, header_requests, sent=True)
+        remember_uploads(google_sheet_id_param, batch_digests)
+    except Exception as e:
+        log_sheet_update_error(e, google_sheet_id_param, "batch sheet update")
         raise
 
+    for stats in results:
+        if isinstance(stats, dict) and not stats.get('error'):
+            logger.info(f"📊 Summary for '{stats['product_name']}': {stats['skus_found']} SKUs found → {stats['skus_after_filter']} after filtering → {stats['rows_uploaded']} uploaded")
+    logger.info(f"--- Batch Google Sheet Update for Sheet ID: {google_sheet_id_param} Finished Successfully ---")
+    return results
+
 if __name__ == '__main__':
     # This part is now more for structure; direct execution might require specific args.
     # For full functionality, use main.py which will handle argument parsing.
-    logger.info("update_google_sheet.py executed directly.")
-    logger.info("This script is primarily designed to be called by main.py with arguments.")
-    logger.info("Attempting run with placeholder/default values (may not work as intended without main.py):")
-    
+    logger.info("update_google_sheet.py executed directly; it is primarily designed to be called by main.py.")
+
     # Example placeholder values - these would normally come from main.py via argparse
     example_product_data_path = "product_data.json"  # Default path if run standalone
     example_product_type = "testprod" 
     example_min_moq = None
     example_max_moq = None
     example_source_url = "https://example.com/default_product.html"  # Placeholder source URL
-    example_google_sheet_id = "your_spreadsheet_id_here"  # Placeholder Google Sheet ID
+    example_google_sheet_id = os.getenv("GOOGLE_SHEET_ID")  # From .env, like the web app
 
-    # Check if a default product_data.json exists, otherwise skip process_and_upload
-    if os.path.exists(example_product_data_path):
+    # Bail out before loading credentials or building the Sheets client if the run cannot succeed
+    if not example_google_sheet_id:
+        logger.warning("GOOGLE_SHEET_ID is not set; skipping the direct test run.")
+    elif not os.path.exists(example_product_data_path):
+        logger.warning(f"Placeholder product_data.json ('{example_product_data_path}') not found; skipping the direct test run.")
+    else:
         run_sheet_update(
             example_product_data_path, 
             example_product_type, 
@@ -1132,7 +1436,3 @@ if __name__ == '__main__':
             example_source_url, 
             example_google_sheet_id
         )
-    else:
-        logger.warning(f"Placeholder product_data.json ('{example_product_data_path}') not found.")
-        logger.info("To test sheet header creation (if sheet service works), you might need to run parts manually or ensure a dummy file.")
-        logger.info("Finished direct execution attempt of update_google_sheet.py.")
@@ -0,0 +1,4 @@
+"""WSGI entry point for production servers, e.g. `gunicorn wsgi:application`."""
+from main import app
+
+application = app